@@ -14,6 +14,8 @@ struct DataSession
   uint16_t m_values[MaxData] = {};
 };
 
+static_assert(sizeof(DataSession) == 44, "the host session store mirrors DataSession as <III16H");
+
 struct DataCollector
 {
   char m_path[16];
@@ -22,6 +24,9 @@ struct DataCollector
   int32_t m_currentBlock = -1;
   int32_t m_currentBlockBegin = 0;
   int32_t m_currentBlockEnd = 0;
+
+  uint32_t m_storedCount = 0;   //sessions in the file, advertised to the gateway
+  uint32_t m_storedBytes = 0;   //flash used by the file's blocks, headers included
 };
 
 void DisplayDataSession(const DataSession &session)
@@ -47,80 +52,260 @@ void DisplayDataSession(const DataSession &session)
   SER("%s\n", buffer); 
 }
 
-bool DisplayDataSessionAtIndex(const DataCollector *collector, uint32_t index, uint32_t minTime)
+//CRC-16/CCITT-FALSE
+uint16_t Crc16(const uint8_t *data, uint32_t size)
+{
+  uint16_t crc = 0xffff;
+
+  for (uint32_t i = 0 ; i < size ; ++i)
+  {
+    crc ^= (uint16_t)data[i] << 8;
+
+    for (int bit = 0 ; bit < 8 ; ++bit)
+      crc = (crc & 0x8000) ? (crc << 1) ^ 0x1021 : (crc << 1);
+  }
+
+  return crc;
+}
+
+//without padding, the host adds it back
+uint32_t EncodeBase64(const uint8_t *data, uint32_t size, char *out)
+{
+  static const char s_chars[] = "ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789+/";
+  uint32_t len = 0;
+
+  for (uint32_t i = 0 ; i < size ; i += 3)
+  {
+    uint32_t v = data[i] << 16;
+    if (i + 1 < size)
+      v |= data[i + 1] << 8;
+    if (i + 2 < size)
+      v |= data[i + 2];
+
+    out[len++] = s_chars[(v >> 18) & 63];
+    out[len++] = s_chars[(v >> 12) & 63];
+    if (i + 1 < size)
+      out[len++] = s_chars[(v >> 6) & 63];
+    if (i + 2 < size)
+      out[len++] = s_chars[v & 63];
+  }
+
+  out[len] = 0;
+  return len;
+}
+
+uint32_t WriteVarint(uint8_t *out, uint32_t value)
 {
+  uint32_t len = 0;
+
+  while (value >= 0x80)
+  {
+    out[len++] = (value & 0x7f) | 0x80;
+    value >>= 7;
+  }
+  out[len++] = value;
+
+  return len;
+}
+
+static constexpr uint8_t SessionFrameVersion = 2;
+
+//binary session frame: version, id, time and period as varints then the values
+//as varint tokens, a run of zeros is (length << 1) | 1 and a value is value << 1,
+//then the crc16 of the preceding bytes. base64 encoded since the terminals carry
+//text. a session with a few readings is about half its text line
+void DisplayDataSessionFrame(const DataSession &session)
+{
+  uint8_t frame[1 + 3 * 5 + DataSession::MaxData * 3 + 2];
+  uint32_t size = 0;
+
+  frame[size++] = SessionFrameVersion;
+  size += WriteVarint(frame + size, session.m_id);
+  size += WriteVarint(frame + size, session.m_time);
+  size += WriteVarint(frame + size, session.m_period);
+
+  const uint16_t *v = session.m_values;
+
+  for (uint32_t i = 0 ; i < DataSession::MaxData ; )
+  {
+    if (v[i] == 0)
+    {
+      uint32_t run = 1;
+      while (i + run < DataSession::MaxData && v[i + run] == 0)
+        run++;
+
+      size += WriteVarint(frame + size, (run << 1) | 1);
+      i += run;
+    }
+    else
+    {
+      size += WriteVarint(frame + size, (uint32_t)v[i] << 1);
+      i++;
+    }
+  }
+
+  const uint16_t crc = Crc16(frame, size);
+  frame[size++] = crc & 0xff;
+  frame[size++] = crc >> 8;
+
+  char buffer[(sizeof(frame) + 2) / 3 * 4 + 1];
+  EncodeBase64(frame, size, buffer);
+
+  SER("s:%s\n", buffer);
+}
+
+struct DisplayCursor
+{
+  uint32_t m_minTime = 0;
+  uint32_t m_next = 0;          //index of the next session to display, among sessions >= m_minTime
+  uint32_t m_block = 0;         //index of the block holding that session
+  uint32_t m_blockSkip = 0;     //sessions before it in that block
+  uint32_t m_displayed = 0;
+  bool m_headerSent = false;
+  bool m_binary = false;
+  bool m_end = false;           //no session left
+};
+
+//displays sessions from the cursor until the terminals are full.
+//AppendOnlyFile only exposes ForEach, so each refill still walks the block
+//list, but blocks before the cursor and after a full terminal are skipped
+//without looking at their sessions, each session is only read once per dump
+bool DisplayDataSessionsFromCursor(const DataCollector *collector, DisplayCursor &cursor)
+{
+  if (cursor.m_end)
+    return true;
+
   uint32_t blockIndex = 0;
-  bool read = false;
+  bool full = false;
 
   auto onBlock = [&](uint32_t size, const void *data)
   {
+    const uint32_t currentBlock = blockIndex++;
+
+    if (full || currentBlock < cursor.m_block)
+      return;
+
     const DataSession *session = (DataSession*)data;
     const DataSession *sessionEnd = (DataSession*)((char*)data + size);
 
+    if (currentBlock == cursor.m_block)
+      session += cursor.m_blockSkip;
+
     while(session < sessionEnd)
     { 
-      if (session->m_time < minTime)
+      if (session->m_time >= cursor.m_minTime)
       {
-        session++;
-        continue;
+        if (!AreTerminalsReady())
+        {
+          full = true;
+          cursor.m_block = currentBlock;
+          cursor.m_blockSkip = session - (DataSession*)data;
+          return;
+        }
+
+        if (cursor.m_binary)
+          DisplayDataSessionFrame(*session);
+        else
+          DisplayDataSession(*session);
+
+        cursor.m_next++;
+        cursor.m_displayed++;
       }
 
-      if (blockIndex == index)
-      {
-        read = true;
+      session++;
+    }
+  };
+
+  AppendOnlyFile file(collector->m_path);
+  file.ForEach(onBlock);
+
+  cursor.m_end = !full;
+  return cursor.m_end;
+}
+
+//skips the first 'index' sessions >= minTime, a host can resume a transfer cut off at 'index'
+void SeekDisplayCursor(const DataCollector *collector, DisplayCursor &cursor, uint32_t index)
+{
+  uint32_t blockIndex = 0;
+  uint32_t sessionIndex = 0;
+  bool found = false;
+
+  auto onBlock = [&](uint32_t size, const void *data)
+  {
+    const uint32_t currentBlock = blockIndex++;
+
+    if (found)
+      return;
+
+    const DataSession *begin = (DataSession*)data;
+    const DataSession *sessionEnd = (DataSession*)((char*)data + size);
+
+    for (const DataSession *session = begin ; session < sessionEnd ; ++session)
+    {
+      if (session->m_time < cursor.m_minTime)
+        continue;
 
-        DisplayDataSession(*session);
+      if (sessionIndex == index)
+      {
+        found = true;
+        cursor.m_block = currentBlock;
+        cursor.m_blockSkip = session - begin;
+        return;
       }
 
-      session++;
-      blockIndex++;
+      sessionIndex++;
     }
   };
 
   AppendOnlyFile file(collector->m_path);
   file.ForEach(onBlock);
 
-  bool done = !read;
-  return done;
+  cursor.m_next = index;
+
+  //past the last session, nothing left to display
+  cursor.m_end = !found;
 }
 
-void DisplayDataSessions(const DataCollector *collector, uint32_t index, uint32_t minTime)
+void DisplayDataSessions(const DataCollector *collector, DisplayCursor cursor)
 {
-  static uint32_t sessionCount = 0;
-
   if (!AreTerminalsReady())
   {
     EventManager::Function f;
-    f = std::bind(DisplayDataSessions, collector, index, minTime);
+    f = std::bind(DisplayDataSessions, collector, cursor);
     DELAY_ADD_EVENT(f, 100 * 1000);
     return;
   }
 
-  if (index == 0)
+  if (!cursor.m_headerSent)
   {
     SER("Data sessions:\n\r");
-    sessionCount = 0;
+    cursor.m_headerSent = true;
   }
 
-  bool done = DisplayDataSessionAtIndex(collector, index, minTime);    
+  bool done = DisplayDataSessionsFromCursor(collector, cursor);
 
   if (!done)
   {
-    sessionCount ++;
-    index++;
     EventManager::Function f;
-    f = std::bind(DisplayDataSessions, collector, index, minTime);
+    f = std::bind(DisplayDataSessions, collector, cursor);
     GJEventManager->Add(f);
   }
   else
   {
-    SER("Total readings:%d\n\r", sessionCount);
+    SER("Total readings:%d\n\r", cursor.m_displayed);
   }
 }
 
-void Display(const DataCollector &collector, uint32_t minTime)
+void Display(const DataCollector &collector, uint32_t minTime, uint32_t startIndex, bool binary)
 {
-  DisplayDataSessions(&collector, 0, minTime);
+  DisplayCursor cursor;
+  cursor.m_minTime = minTime;
+  cursor.m_binary = binary;
+
+  if (startIndex != 0)
+    SeekDisplayCursor(&collector, cursor, startIndex);
+
+  DisplayDataSessions(&collector, cursor);
 }
 
 void DisplayActiveDataSession(const DataCollector *collector)
@@ -129,11 +314,20 @@ void DisplayActiveDataSession(const DataCollector *collector)
 }
 
 
-void WriteDataSession(const char *path, const DataSession &session)
+//flash taken by a block of 'size' bytes: the append-only file keeps a
+//4 byte size before each block and pads its data to 4 bytes
+uint32_t GetStoredBlockSize(uint32_t size)
+{
+  return sizeof(uint32_t) + ((size + 3) & ~3);
+}
+
+//returns true when the file was full and had to be erased first
+bool WriteDataSession(const char *path, const DataSession &session)
 {
   AppendOnlyFile file(path);
 
   const uint32_t size = sizeof(DataSession);
+  bool erased = false;
 
   if (!file.BeginWrite(size))
   {
@@ -141,16 +335,31 @@ void WriteDataSession(const char *path, const DataSession &session)
     SER("Session file erased\n\r");
     bool ret = file.BeginWrite(size);
     APP_ERROR_CHECK_BOOL(ret);
+    erased = true;
   }
   file.Write(&session, size);
   file.EndWrite();
 
   SER("Session file written\n\r");
+
+  return erased;
+}
+
+void WriteDataSession(DataCollector &collector, const DataSession &session)
+{
+  if (WriteDataSession(collector.m_path, session))
+  {
+    collector.m_storedCount = 0;
+    collector.m_storedBytes = 0;
+  }
+
+  collector.m_storedCount++;
+  collector.m_storedBytes += GetStoredBlockSize(sizeof(DataSession));
 }
 
 void WriteDataSession(DataCollector &collector)
 {
-  WriteDataSession(collector.m_path, collector.m_dataSession);
+  WriteDataSession(collector, collector.m_dataSession);
 }
 
 bool AddSessionData(DataCollector &collector, uint32_t time, uint16_t value)
@@ -225,9 +434,23 @@ void ClearStorage(DataCollector &collector)
 {
   AppendOnlyFile file(collector.m_path);
   file.Erase();
+
+  collector.m_storedCount = 0;
+  collector.m_storedBytes = 0;
+
   SER("cleared\n\r");
 }
 
+uint32_t GetStoredSessionCount(const DataCollector &collector)
+{
+  return collector.m_storedCount;
+}
+
+uint32_t GetStoredBytes(const DataCollector &collector)
+{
+  return collector.m_storedBytes;
+}
+
 uint32_t GetBlockEndTime(const DataCollector &collector)
 {
   const DataSession &dataSession = collector.m_dataSession;
@@ -264,7 +487,7 @@ void WriteDebugData(DataCollector &collector)
   for (int i = 0 ; i < DataSession::MaxData ; ++i)
     session.m_values[i] = i;
 
-    WriteDataSession(collector.m_path, session);
+    WriteDataSession(collector, session);
 }
 
 DataCollector* InitDataCollector(const char *path, uint32_t id, uint32_t period)
@@ -277,5 +500,15 @@ DataCollector* InitDataCollector(const char *path, uint32_t id, uint32_t period)
 
   InitDataSession(collector->m_dataSession, GetUnixtime());
 
+  //count what previous runs stored, kept up to date by the writes afterward
+  auto onBlock = [&](uint32_t size, const void *data)
+  {
+    collector->m_storedCount += size / sizeof(DataSession);
+    collector->m_storedBytes += GetStoredBlockSize(size);
+  };
+
+  AppendOnlyFile file(collector->m_path);
+  file.ForEach(onBlock);
+
   return collector;
 }
\ No newline at end of file
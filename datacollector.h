@@ -14,5 +14,7 @@ void WriteDataSession(DataCollector &collector);
 void InitDataSession(DataCollector &collector, uint32_t time);
 bool IsExpired(const DataCollector &collector, uint32_t time);
 void ClearStorage(DataCollector &collector);
-void Display(const DataCollector &collector, uint32_t minTime);
+uint32_t GetStoredSessionCount(const DataCollector &collector);
+uint32_t GetStoredBytes(const DataCollector &collector);
+void Display(const DataCollector &collector, uint32_t minTime, uint32_t startIndex = 0, bool binary = false);
 void DisplayActiveDataSession(const DataCollector *collector);
@@ -2,6 +2,7 @@
 #include "softdevice_handler.h"
 #include "nrf_log_ctrl.h"
 #include "nrf_gpio.h"
+#include <string.h>
 
 #include "gj/base.h"
 #include "gj/gjbleserver.h"
@@ -77,29 +78,89 @@ GJOTA ota;
 BuiltInTemperatureSensor tempSensor;
 AnalogSensor battSensor(10);
 
+//advert payload, the gateway only connects when it shows something to fetch.
+//version 1 was m_lastSessionUnixtime alone.
+//the advert holds 31 bytes: flags(3), name(2 + name length), manuf data(6 + sizeof(ManufData)),
+//the whole payload only fits names of 6 characters or less, see RefreshManufData
+struct __attribute__((packed)) ManufData
+{
+  uint32_t m_lastSessionUnixtime;
+  uint8_t m_version;
+  uint8_t m_flashFill;        //percent of the session file used
+  uint16_t m_batt;            //last battery sample, 0 before the first one
+  uint16_t m_sessionCount;    //sessions stored
+  uint16_t m_lastError;
+  uint16_t m_tagHash;         //FNV-1a of the firmware tag, folded to 16 bits
+};
+
+static_assert(sizeof(ManufData) == 14, "the gateway decodes ManufData as <IBBHHHH");
+
+static constexpr uint8_t ManufDataVersion = 2;
+ManufData s_manufData = {};
+
+//8 sectors, see DEFINE_FILE_SECTORS(turndata...)
+const uint32_t turnDataFileSize = 8 * NRF_FLASH_SECTOR_SIZE;
+
+static bool s_printBatt = false;
+
+static constexpr uint32_t AdvertSize = 31;
+static constexpr uint32_t AdvertFlagsSize = 3;
+static constexpr uint32_t AdvertNameHeaderSize = 2;
+static constexpr uint32_t AdvertManufHeaderSize = 6;
+
+const char *GetHostName();
+
+uint32_t GetManufDataSize()
+{
+  //a longer host name gets the version 1 payload, the gateway reads the rest over a connection
+  const uint32_t nameSize = AdvertNameHeaderSize + strlen(GetHostName());
+  if (AdvertFlagsSize + nameSize + AdvertManufHeaderSize + sizeof(ManufData) <= AdvertSize)
+    return sizeof(ManufData);
+
+  return sizeof(s_manufData.m_lastSessionUnixtime);
+}
+
+void RefreshManufData()
+{
+  if (bleServer.IsInit())
+    bleServer.SetAdvManufData(&s_manufData, GetManufDataSize());
+}
+
 void OnBattReady(AnalogSensor &sensor)
 {
-  SER("Batt:%d\n\r", sensor.GetValue());
+  s_manufData.m_batt = sensor.GetValue();
+  RefreshManufData();
+
+  if (s_printBatt)
+  {
+    SER("Batt:%d\n\r", sensor.GetValue());
+    s_printBatt = false;
+  }
 }
 
-void Command_ReadBattery()
+void SampleBattery()
 {
   battSensor.SetPin(GJ_ADC_VDD_PIN);
   battSensor.SetOnReady(OnBattReady);
   battSensor.Sample();
 }
 
-struct ManufData
+void Command_ReadBattery()
 {
-  uint32_t m_lastSessionUnixtime;
-};
-
-ManufData s_manufData = {};
+  s_printBatt = true;
+  SampleBattery();
+}
 
-void RefreshManufData()
+uint16_t HashTag(const char *tag)
 {
-  if (bleServer.IsInit())
-    bleServer.SetAdvManufData(&s_manufData, sizeof(s_manufData));
+  uint32_t hash = 2166136261;
+  for (const char *c = tag ; *c ; ++c)
+  {
+    hash ^= (uint8_t)*c;
+    hash *= 16777619;
+  }
+
+  return (hash >> 16) ^ (hash & 0xffff);
 }
 
 #define TD_ERR_NOT_ADDED 1001
@@ -125,6 +186,20 @@ TurnData::TurnData()
 
 }
 
+void UpdateManufData(uint32_t lastSessionUnixtime)
+{
+  const DataCollector &collector = *turnData.m_collector;
+
+  s_manufData.m_lastSessionUnixtime = lastSessionUnixtime;
+  s_manufData.m_version = ManufDataVersion;
+  s_manufData.m_flashFill = Min<uint32_t>(GetStoredBytes(collector) * 100 / turnDataFileSize, 100);
+  s_manufData.m_sessionCount = Min<uint32_t>(GetStoredSessionCount(collector), 0xffff);
+  s_manufData.m_lastError = turnData.m_LastError;
+  s_manufData.m_tagHash = HashTag(tag_app);
+
+  RefreshManufData();
+}
+
 void OnTurnDataTimer();
 void SetTurnDataTimer();
 
@@ -138,9 +213,11 @@ void WriteTurnData(uint32_t time)
   WriteDataSession(*turnData.m_collector);
   InitDataSession(*turnData.m_collector, time);
 
-  //update manuf unixtime after file write
-  s_manufData.m_lastSessionUnixtime = sessionTime;
-  RefreshManufData();
+  //update manuf data after file write
+  UpdateManufData(sessionTime);
+
+  //the battery follows in the advert once sampled
+  SampleBattery();
 
   turnData.m_timerSet = false;
 }
@@ -302,17 +379,40 @@ DEFINE_FILE_SECTORS(config,     "/config",    FILE_SECTOR_CONFIG,     1);
   END_BOOT_PARTITIONS()
 #endif
 
-void Command_TurnDataDisp(const CommandInfo &commandInfo)
+void ParseDisplayArgs(const CommandInfo &commandInfo, uint32_t &minTime, uint32_t &startIndex)
 {
-  uint32_t minTime = 0;
-
   if (commandInfo.m_argCount >= 1)
   {
     StringView arg1 = commandInfo.m_args[0];
     minTime = strtol(arg1.data(), NULL, 0);
   }
 
-  Display(*turnData.m_collector, minTime);
+  if (commandInfo.m_argCount >= 2)
+  {
+    StringView arg2 = commandInfo.m_args[1];
+    startIndex = strtol(arg2.data(), NULL, 0);
+  }
+}
+
+//turndata disp [minTime] [startIndex]
+void Command_TurnDataDisp(const CommandInfo &commandInfo)
+{
+  uint32_t minTime = 0;
+  uint32_t startIndex = 0;
+  ParseDisplayArgs(commandInfo, minTime, startIndex);
+
+  Display(*turnData.m_collector, minTime, startIndex);
+}
+
+//turndata bindisp [minTime] [startIndex]
+//same as disp, sessions are sent as crc checked binary frames
+void Command_TurnDataBinDisp(const CommandInfo &commandInfo)
+{
+  uint32_t minTime = 0;
+  uint32_t startIndex = 0;
+  ParseDisplayArgs(commandInfo, minTime, startIndex);
+
+  Display(*turnData.m_collector, minTime, startIndex, true);
 }
 void Command_TurnDataActive(const CommandInfo &commandInfo)
 {
@@ -321,6 +421,7 @@ void Command_TurnDataActive(const CommandInfo &commandInfo)
 void Command_TurnDataClear(const CommandInfo &commandInfo)
 {
   ClearStorage(*turnData.m_collector);
+  UpdateManufData(s_manufData.m_lastSessionUnixtime);
 }
 void Command_TurnDataDebugTrigger(const CommandInfo &commandInfo)
 {
@@ -329,9 +430,8 @@ void Command_TurnDataDebugTrigger(const CommandInfo &commandInfo)
 }
 void Command_TurnDataWriteDbg(const CommandInfo &commandInfo)
 {
-  s_manufData.m_lastSessionUnixtime = GetUnixtime();
-  RefreshManufData();
   WriteDebugData(*turnData.m_collector);
+  UpdateManufData(GetUnixtime());
   SER("Debug Data written\n\r");
 }
 
@@ -383,7 +483,8 @@ void Command_turndata(const char *command)
     "clear",
     "debugtrigger",
     "writedbg",
-    "info"
+    "info",
+    "bindisp"
   };
 
   static void (*const s_argsFuncs[])(const CommandInfo &commandInfo){
@@ -393,9 +494,10 @@ void Command_turndata(const char *command)
     Command_TurnDataDebugTrigger,
     Command_TurnDataWriteDbg,
     Command_TurnDataInfo,
+    Command_TurnDataBinDisp,
     };
 
-  const SubCommands subCommands = {6, s_argsName, s_argsFuncs};
+  const SubCommands subCommands = {7, s_argsName, s_argsFuncs};
 
   SubCommandForwarder(command, subCommands);
 }
@@ -513,6 +615,8 @@ int main(void)
   
   uint32_t turnDataId = GJ_CONF_INT32_VALUE(wheeldataid);
   turnData.m_collector = InitDataCollector("/turndata", turnDataId, period);
+  UpdateManufData(0);
+  SampleBattery();
 
   //disable BLE server off when resetting
   //This is to prevent turning off BLE serv outside of expected window because of desynchronized unixtime 
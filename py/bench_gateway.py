@@ -0,0 +1,114 @@
+import os
+import sys
+import time
+import asyncio
+import tempfile
+import contextlib
+import pepperoni
+import blesim
+from ingestserver import IngestServer
+
+#end to end gateway benchmark against simulated modules, no BLE adapter needed:
+#sessions per second, connection times and upload latency for 1 to 100 modules
+#usage: bench_gateway.py [devices=1,10,100] [sessions=20] [maxconn=4] [interval=0.001]
+#  [drop=0] [fail=0] [batch=16] [flush=0.2] [timeout=300] [metrics=F] [text] [verbose]
+#  interval  seconds between notifications
+#  drop      rate of lost notifications
+#  fail      rate of failed connections
+#  text      modules without "turndata bindisp"
+#  metrics   writes the gateway metrics of the last run as json to F
+
+def Percentile(values, percent:float):
+  if len(values) == 0:
+    return 0
+  values = sorted(values)
+  return values[min(len(values) - 1, int(len(values) * percent / 100))]
+
+async def RunBenchmark(deviceCount:int, options):
+  pepperoni.metrics.Reset()
+  server = IngestServer().Start()
+  stats = blesim.SimStats()
+  link = blesim.SimLink(packetInterval=options["interval"], dropRate=options["drop"],
+    connectFailRate=options["fail"], advertInterval=0.5)
+  modules = blesim.MakeModules(deviceCount, options["sessions"], link, stats, binaryDisp=options["binary"])
+  blesim.Install(pepperoni, modules)
+  expected = deviceCount * options["sessions"]
+
+  with tempfile.TemporaryDirectory() as directory:
+    gateway = pepperoni.Gateway(server.GetUrl(), options["maxconn"], directory + "/sessions.db")
+    gateway.uploader.batchSize = options["batch"]
+    gateway.uploader.flushInterval = options["flush"]
+
+    for module in modules:
+      path = directory + "/" + module.name
+      gateway.instances.append(pepperoni.DeviceInstance(gateway, module.name,
+        path + "_readings.txt", path + "_newreadings.txt", path + ".bin", path + ".json"))
+
+    begin = time.monotonic()
+    task = asyncio.create_task(pepperoni.RunGateway(gateway, 0))
+    try:
+      while len(server.received) < expected and time.monotonic() - begin < options["timeout"]:
+        await asyncio.sleep(0.05)
+    finally:
+      elapsed = time.monotonic() - begin
+      task.cancel()
+      with contextlib.suppress(asyncio.CancelledError):
+        await task
+
+  server.Stop()
+
+  latencies = [server.received[key] - stats.emitted[key] for key in server.received if key in stats.emitted]
+  received = len(server.received)
+  return {
+    "devices" : deviceCount,
+    "sessions" : "{0}/{1}".format(received, expected),
+    "elapsed" : elapsed,
+    "sessions/s" : received / elapsed if elapsed else 0,
+    "connects" : "{0}+{1}f".format(stats.connects, stats.connectFailures),
+    "connect ms" : 1000 * sum(stats.connectTimes) / max(len(stats.connectTimes), 1),
+    "hold p50 s" : Percentile(stats.holdTimes, 50),
+    "hold p95 s" : Percentile(stats.holdTimes, 95),
+    "upload p50 ms" : 1000 * Percentile(latencies, 50),
+    "upload p95 ms" : 1000 * Percentile(latencies, 95),
+    "upload p99 ms" : 1000 * Percentile(latencies, 99),
+    "air KB" : stats.bytes / 1024,
+    "dropped" : stats.packetsDropped }
+
+def PrintResults(results):
+  columns = list(results[0].keys())
+  print("  ".join("{0:>13}".format(column) for column in columns))
+  for result in results:
+    print("  ".join("{0:>13.2f}".format(result[c]) if isinstance(result[c], float) else "{0:>13}".format(result[c]) for c in columns))
+
+async def Main(argv):
+  GetArgValue = pepperoni.GetArgValue
+  options = {
+    "sessions" : int(GetArgValue(argv, "sessions", 20)),
+    "maxconn" : int(GetArgValue(argv, "maxconn", 4)),
+    "interval" : float(GetArgValue(argv, "interval", 0.001)),
+    "drop" : float(GetArgValue(argv, "drop", 0)),
+    "fail" : float(GetArgValue(argv, "fail", 0)),
+    "batch" : int(GetArgValue(argv, "batch", 16)),
+    "flush" : float(GetArgValue(argv, "flush", 0.2)),
+    "timeout" : float(GetArgValue(argv, "timeout", 300)),
+    "binary" : "text" not in argv }
+  deviceCounts = [int(count) for count in GetArgValue(argv, "devices", "1,10,100").split(",")]
+
+  results = []
+  for deviceCount in deviceCounts:
+    #the gateway logs every line it handles
+    with open(os.devnull, "w") as log, contextlib.ExitStack() as stack:
+      if "verbose" not in argv:
+        stack.enter_context(contextlib.redirect_stdout(log))
+      results.append(await RunBenchmark(deviceCount, options))
+    print("{0} devices done".format(deviceCount), file=sys.stderr)
+
+  print(" ".join("{0}={1}".format(key, value) for key, value in options.items()))
+  PrintResults(results)
+
+  metricsFilepath = GetArgValue(argv, "metrics", None)
+  if metricsFilepath is not None:
+    pepperoni.metrics.WriteJson(metricsFilepath)
+
+if __name__ == "__main__":
+  asyncio.run(Main(sys.argv))
@@ -0,0 +1,71 @@
+import sys
+import time
+import random
+from sessionstore import ParseSession, ParseSessions, DecodeSessionFrame, numpy
+from sessionstore import EncodeSessionFrame, framePrefix
+
+#parsing throughput of session lines
+#usage: bench_parse.py [sessionCount]
+
+def MakeDump(count:int):
+  lines = ["Data sessions:"]
+  sessionTime = 1600000000
+  for i in range(count):
+    values = [random.choice((0, 0, 0, random.randint(1, 400))) for v in range(16)]
+    lines.append("id:7 t:{0} p:900 {1}".format(sessionTime, " ".join(map(str, values))))
+    sessionTime += 900 * 16
+  lines.append("Total readings:{0}".format(count))
+  return "\n\r".join(lines) + "\n\r"
+
+def MakeBinaryDump(text:str):
+  #the same sessions as "turndata bindisp" frames
+  lines = ["Data sessions:"]
+  count = 0
+  for line in text.splitlines():
+    if line.startswith("id:"):
+      lines.append(EncodeSessionFrame(ParseSession(line)))
+      count += 1
+  lines.append("Total readings:{0}".format(count))
+  return "\n".join(lines) + "\n"
+
+def SplitParse(text:str):
+  #the previous GetSessionTime/GetSessionPeriod/SendTempSession splitting,
+  #each session line was split once per field lookup
+  def GetVarValue(t):
+    words = t.split(":")
+    return words[1]
+
+  sessions = []
+  for line in text.splitlines():
+    if line.find("id:") != -1 and line.find("t:") != -1 and line.find("p:") != -1:
+      sessionTime = int(GetVarValue(line.split(" ")[1]))
+      period = int(GetVarValue(line.split(" ")[2]))
+      words = line.split(" ")
+      sessions.append((GetVarValue(words[0]), sessionTime, period, ",".join(words[3:len(words)])))
+  return sessions
+
+def PerLineParse(text:str):
+  return [ParseSession(line) for line in text.splitlines() if line.startswith("id:")]
+
+def PerFrameDecode(text:str):
+  return [DecodeSessionFrame(line) for line in text.splitlines() if line.startswith(framePrefix)]
+
+def Measure(name:str, function, text:str, count:int):
+  begin = time.perf_counter()
+  result = function(text)
+  elapsed = time.perf_counter() - begin
+  assert len(result) == count
+  print("{0:<16} {1:>10.0f} sessions/s ({2:.1f} ms)".format(name, count / elapsed, elapsed * 1000))
+
+if __name__ == "__main__":
+  count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+  text = MakeDump(count)
+
+  print("{0} sessions, {1} bytes, numpy:{2}".format(count, len(text), numpy is not None))
+  Measure("split (previous)", SplitParse, text, count)
+  Measure("ParseSession", PerLineParse, text, count)
+  Measure("ParseSessions", ParseSessions, text, count)
+
+  binaryText = MakeBinaryDump(text)
+  print("binary frames, {0} bytes ({1:.0f}% of text)".format(len(binaryText), len(binaryText) * 100 / len(text)))
+  Measure("DecodeFrame", PerFrameDecode, binaryText, count)
@@ -0,0 +1,122 @@
+import os
+import sys
+import time
+import asyncio
+import contextlib
+import pepperoni
+from sessionstore import ParseSession
+from ingestserver import IngestServer
+from bench_parse import MakeDump
+from bench_gateway import Percentile
+
+#replays readings.txt history through the gateway's upload path
+#(UploadService and SendTempSessions) and reports requests per second
+#and latency percentiles. runs against a local ingest server unless server=URL
+#usage: bench_upload.py [readings.txt] [mod=peppeA] [server=URL] [cafile=F]
+#  [concurrency=2] [batch=16] [repeat=1] [latency=S] [jitter=S] [errors=RATE] [nobatch] [nopacked] [verbose]
+#  without readings.txt, 1000 generated sessions are replayed
+#  repeat     replays the history N times, as N modules
+#  latency, jitter, errors, nobatch    local ingest server behaviour
+#  nopacked   text batches, on both ends
+
+class TimedUploadService(pepperoni.UploadService):
+  #records the latency and status of every request
+  def __init__(self, server:str, workerCount:int):
+    super().__init__(server, workerCount)
+    self.latencies = []
+    self.statuses = {}
+
+  async def Send(self, url:str, urlParams, body:bytes = None, contentType:str = None):
+    begin = time.perf_counter()
+    status = await super().Send(url, urlParams, body, contentType)
+    self.latencies.append(time.perf_counter() - begin)
+    self.statuses[status] = self.statuses.get(status, 0) + 1
+    return status
+
+def LoadRecords(argv):
+  lines = None
+  for arg in argv[1:]:
+    if "=" not in arg and os.path.exists(arg):
+      with open(arg, "r") as readings:
+        lines = readings.read().splitlines()
+
+  if lines is None:
+    lines = MakeDump(1000).splitlines()
+
+  records = []
+  for line in lines:
+    try:
+      records.append(ParseSession(line))
+    except ValueError:
+      pass
+  return records
+
+async def Replay(uploader:TimedUploadService, chunks:asyncio.Queue, result):
+  #one sender, unacknowledged sessions are sent again up to 5 times
+  while chunks.empty() == False:
+    mod, chunk = chunks.get_nowait()
+    for attempt in range(6):
+      ackCount = await pepperoni.SendTempSessions(uploader, mod, chunk)
+      result["acknowledged"] += ackCount
+      chunk = chunk[ackCount:]
+      if len(chunk) == 0:
+        break
+      result["retries"] += 1
+    result["failed"] += len(chunk)
+
+async def Main(argv):
+  GetArgValue = pepperoni.GetArgValue
+  records = LoadRecords(argv)
+  mod = GetArgValue(argv, "mod", "peppeA")
+  concurrency = int(GetArgValue(argv, "concurrency", 2))
+  batchSize = int(GetArgValue(argv, "batch", 16))
+  repeat = int(GetArgValue(argv, "repeat", 1))
+
+  ingest = None
+  server = GetArgValue(argv, "server", None)
+  if server is None:
+    ingest = IngestServer(latency=float(GetArgValue(argv, "latency", 0)), jitter=float(GetArgValue(argv, "jitter", 0)),
+      errorRate=float(GetArgValue(argv, "errors", 0)), batch="nobatch" not in argv, packed="nopacked" not in argv).Start()
+    server = ingest.GetUrl()
+
+  cafile = GetArgValue(argv, "cafile", None)
+  if cafile is not None:
+    pepperoni.sslContext.load_verify_locations(cafile)
+
+  chunks = asyncio.Queue()
+  for i in range(repeat):
+    name = mod if repeat == 1 else "{0}_{1}".format(mod, i)
+    for begin in range(0, len(records), batchSize):
+      chunks.put_nowait((name, records[begin:begin + batchSize]))
+
+  uploader = TimedUploadService(server, concurrency)
+  uploader.packedSupported = "nopacked" not in argv
+  result = {"acknowledged" : 0, "retries" : 0, "failed" : 0}
+
+  #the upload path logs every request
+  with open(os.devnull, "w") as log, contextlib.ExitStack() as stack:
+    if "verbose" not in argv:
+      stack.enter_context(contextlib.redirect_stdout(log))
+
+    uploader.Start()
+    begin = time.perf_counter()
+    await asyncio.gather(*[Replay(uploader, chunks, result) for i in range(concurrency)])
+    elapsed = time.perf_counter() - begin
+    await uploader.Stop()
+
+  latencies = uploader.latencies
+  print("server {0}, {1} sessions x{2}, batch {3}, concurrency {4}, packed endpoint {5}, batch endpoint {6}".format(
+    server, len(records), repeat, batchSize, concurrency, uploader.packedSupported, uploader.batchSupported))
+  print("requests {0} in {1:.2f}s, {2:.1f} req/s, {3:.1f} sessions/s".format(
+    len(latencies), elapsed, len(latencies) / elapsed, result["acknowledged"] / elapsed))
+  print("latency ms p50 {0:.1f} p95 {1:.1f} p99 {2:.1f} max {3:.1f}".format(
+    1000 * Percentile(latencies, 50), 1000 * Percentile(latencies, 95), 1000 * Percentile(latencies, 99), 1000 * max(latencies, default=0)))
+  print("status {0}, acknowledged {1}, retries {2}, failed {3}".format(
+    uploader.statuses, result["acknowledged"], result["retries"], result["failed"]))
+
+  if ingest is not None:
+    print("ingest server: {0} sessions, {1} duplicates, responses {2}".format(len(ingest.received), ingest.duplicates, ingest.counts))
+    ingest.Stop()
+
+if __name__ == "__main__":
+  asyncio.run(Main(sys.argv))
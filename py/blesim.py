@@ -0,0 +1,319 @@
+import sys
+import time
+import random
+import struct
+import asyncio
+from sessionstore import maxValues, recordStruct, EncodeSessionFrame
+
+#offline stand-in for BleakScanner/BleakClient, simulated modules answer
+#the gjcommand: protocol of the firmware on service 0xEE / char 0xEE01.
+#Install() swaps pepperoni's BleakScanner and BleakClient for the
+#simulated ones, see bench_gateway.py
+
+serviceUuid = "000000ee-0000-1000-8000-00805f9b34fb"
+charUuid = "0000ee01-0000-1000-8000-00805f9b34fb"
+charHandle = 14
+manufId = 65535
+
+#manufacturer data version 2, see ManufData in main.cpp.
+#it only fits in the advert next to names of up to 6 characters,
+#modules with longer names advertise version 1
+advertStruct = struct.Struct("<IBBHHHH")
+advertMaxNameLength = 6
+
+class SimLink:
+  #radio behaviour shared by the simulated modules
+  def __init__(self, mtu:int = 20, packetInterval:float = 0.0075, connectDelay:float = 0.05,
+    dropRate:float = 0, connectFailRate:float = 0, advertInterval:float = 1.0):
+    self.mtu = mtu                          #notification payload size
+    self.packetInterval = packetInterval    #seconds between notifications
+    self.connectDelay = connectDelay
+    self.dropRate = dropRate                #notifications lost
+    self.connectFailRate = connectFailRate  #connections failing
+    self.advertInterval = advertInterval
+
+class SimStats:
+  def __init__(self):
+    self.connects = 0
+    self.connectFailures = 0
+    self.connectTimes = []    #seconds to connect
+    self.holdTimes = []       #seconds a connection was held
+    self.packets = 0
+    self.packetsDropped = 0
+    self.bytes = 0
+    self.emitted = {}         #(module name, session time) -> first emission, time.monotonic()
+
+class SimSession:
+  __slots__ = ("time", "id", "period", "values")
+
+  def __init__(self, time:int, id:int, period:int, values):
+    self.time = time
+    self.id = id
+    self.period = period
+    self.values = values
+
+class SimModule:
+  #one pepperoni module: its stored sessions and the commands it answers
+  def __init__(self, name:str, address:str, link:SimLink, stats:SimStats, period:int = 900,
+    batt:int = 2900, tag:str = "sim", advertVersion:int = 2, binaryDisp:bool = True, rssi:int = -60):
+    self.name = name
+    self.address = address
+    self.link = link
+    self.stats = stats
+    self.period = period
+    self.batt = batt
+    self.tag = tag
+    self.advertVersion = advertVersion
+    self.binaryDisp = binaryDisp
+    self.rssi = rssi
+    self.sessions = []
+    self.lastError = 0
+    self.unixtimeOffset = 0
+
+  def AddSessions(self, count:int, endTime:int = None, dataId:int = 0):
+    #count sessions of 16 periods, the last one ending at endTime
+    sessionLength = self.period * maxValues
+    endTime = int(time.time()) if endTime is None else endTime
+    for i in range(count):
+      sessionTime = endTime - (count - i) * sessionLength
+      values = [random.choice((0, 0, 0, random.randint(1, 400))) for v in range(maxValues)]
+      self.sessions.append(SimSession(sessionTime, dataId, self.period, values))
+
+  def GetManufData(self):
+    #as received by the gateway: payload length + 1, 0xff then the payload
+    lastTime = self.sessions[-1].time if self.sessions else 0
+    if self.advertVersion < 2 or len(self.name) > advertMaxNameLength:
+      payload = struct.pack("<I", lastTime)
+    else:
+      value = 2166136261
+      for c in self.tag.encode():
+        value = ((value ^ c) * 16777619) & 0xffffffff
+      tagHash = (value >> 16) ^ (value & 0xffff)
+
+      #each session is a block of the firmware's append-only file, after a 4 byte size
+      storedBytes = len(self.sessions) * (4 + recordStruct.size)
+      flashFill = min(storedBytes * 100 // (8 * 1024), 100)
+      payload = advertStruct.pack(lastTime, 2, flashFill, self.batt, min(len(self.sessions), 0xffff), self.lastError, tagHash)
+    return bytes([len(payload) + 1, 0xff]) + payload
+
+  def HandleCommand(self, cmd:str):
+    #returns the response lines, with the firmware's line endings
+    words = cmd.split()
+    if len(words) == 0:
+      return []
+
+    if words[0] == "unixtime" and len(words) > 1:
+      self.unixtimeOffset = ParseLong(words[1]) - int(time.time())
+      return ["Unixtime:{0}\n\r".format(words[1])]
+
+    if words[0] == "batt":
+      return ["Batt:{0}\n\r".format(self.batt)]
+
+    if words[0] == "version":
+      return [
+        "NRF51 Pepperoni (0x1c000, size:40000) \r\n",
+        "Hostname:{0}\n\r".format(self.name),
+        "App version {0} (Built:sim)\n\r".format(self.tag),
+        "GJ hash sim\n\r"]
+
+    if words[0] == "turndata" and len(words) > 1:
+      if words[1] == "clear":
+        self.sessions = []
+        return ["cleared\n\r"]
+
+      if words[1] == "disp" or (words[1] == "bindisp" and self.binaryDisp):
+        minTime = ParseLong(words[2]) if len(words) > 2 else 0
+        startIndex = ParseLong(words[3]) if len(words) > 3 else 0
+        return self.Display(minTime, startIndex, words[1] == "bindisp")
+
+    return ["Unknown command '{0}'\n\r".format(cmd)]
+
+  def Display(self, minTime:int, startIndex:int, binary:bool):
+    sessions = [session for session in self.sessions if session.time >= minTime][startIndex:]
+
+    lines = ["Data sessions:\n\r"]
+    for session in sessions:
+      self.stats.emitted.setdefault((self.name, session.time), time.monotonic())
+      if binary:
+        lines.append(EncodeSessionFrame(session) + "\n")
+      else:
+        lines.append("id:{0} t:{1} p:{2} {3}\n".format(session.id, session.time, session.period, " ".join(map(str, session.values))))
+    lines.append("Total readings:{0}\n\r".format(len(sessions)))
+    return lines
+
+def ParseLong(text:str):
+  #strtol(text, NULL, 0) as the firmware parses its arguments, "12.0" is 12
+  digits = ""
+  for c in text:
+    if c.isdigit() == False and (c != "-" or digits):
+      break
+    digits += c
+  return int(digits) if digits.strip("-") else 0
+
+class SimDevice:
+  #what the scanner reports, stands for bleak's BLEDevice
+  def __init__(self, module:SimModule):
+    self.module = module
+    self.address = module.address
+    self.name = module.name
+
+class SimAdvertisementData:
+  def __init__(self, module:SimModule):
+    self.local_name = module.name
+    self.manufacturer_data = {manufId: module.GetManufData()}
+    self.rssi = module.rssi
+
+class SimScanner:
+  #BleakScanner(detection_callback=...) replacement, each module advertises
+  #every link.advertInterval seconds, with a random phase
+  modules = []
+
+  def __init__(self, detection_callback=None):
+    self.callback = detection_callback
+    self.tasks = []
+
+  async def start(self):
+    for module in self.modules:
+      self.tasks.append(asyncio.create_task(self.Advertise(module)))
+
+  async def stop(self):
+    for task in self.tasks:
+      task.cancel()
+    self.tasks = []
+
+  async def Advertise(self, module:SimModule):
+    device = SimDevice(module)
+    await asyncio.sleep(random.uniform(0, module.link.advertInterval))
+    while True:
+      if self.callback is not None:
+        self.callback(device, SimAdvertisementData(module))
+      await asyncio.sleep(module.link.advertInterval)
+
+class SimCharacteristic:
+  def __init__(self, uuid:str, handle:int):
+    self.uuid = uuid
+    self.handle = handle
+
+class SimService:
+  def __init__(self, uuid:str):
+    self.uuid = uuid
+    self.characteristics = {charUuid: SimCharacteristic(charUuid, charHandle)}
+
+  def get_characteristic(self, uuid:str):
+    return self.characteristics.get(uuid)
+
+class SimServices:
+  def __init__(self):
+    self.services = {serviceUuid: SimService(serviceUuid)}
+
+  def get_service(self, uuid:str):
+    return self.services.get(uuid)
+
+class SimClient:
+  #BleakClient(device) replacement, used as "async with".
+  #writes to the command characteristic are answered with notifications
+  #of link.mtu bytes, link.packetInterval apart
+  def __init__(self, device:SimDevice):
+    self.module = device.module
+    self.link = device.module.link
+    self.stats = device.module.stats
+    self.connected = False
+    self.notifyCallback = None
+    self.responder = None
+    self.connectedTime = 0
+
+  async def __aenter__(self):
+    await self.connect()
+    return self
+
+  async def __aexit__(self, excType, exc, tb):
+    await self.disconnect()
+
+  async def connect(self):
+    begin = time.monotonic()
+    await asyncio.sleep(self.link.connectDelay)
+    if random.random() < self.link.connectFailRate:
+      self.stats.connectFailures += 1
+      raise ConnectionError("simulated connection failure with {0}".format(self.module.name))
+
+    self.connected = True
+    self.connectedTime = time.monotonic()
+    self.stats.connects += 1
+    self.stats.connectTimes.append(self.connectedTime - begin)
+
+  async def disconnect(self):
+    if self.responder is not None:
+      self.responder.cancel()
+      self.responder = None
+    if self.connected:
+      self.connected = False
+      self.stats.holdTimes.append(time.monotonic() - self.connectedTime)
+
+  async def is_connected(self):
+    return self.connected
+
+  async def get_services(self):
+    return SimServices()
+
+  async def start_notify(self, char, callback):
+    self.notifyCallback = callback
+
+  async def stop_notify(self, char):
+    self.notifyCallback = None
+
+  async def write_gatt_char(self, char, data):
+    if self.connected == False:
+      raise ConnectionError("not connected")
+
+    text = bytes(data).decode()
+    if text.startswith("gjcommand:") == False:
+      return
+
+    lines = self.module.HandleCommand(text[len("gjcommand:"):])
+    previous = self.responder
+    self.responder = asyncio.create_task(self.Respond(previous, "".join(lines).encode()))
+
+  async def Respond(self, previous, data:bytes):
+    #the module answers one command at a time
+    if previous is not None:
+      await asyncio.wait([previous])
+
+    for offset in range(0, len(data), self.link.mtu):
+      await asyncio.sleep(self.link.packetInterval)
+      if random.random() < self.link.dropRate:
+        self.stats.packetsDropped += 1
+        continue
+      packet = data[offset:offset + self.link.mtu]
+      self.stats.packets += 1
+      self.stats.bytes += len(packet)
+      if self.notifyCallback is not None:
+        self.notifyCallback(charHandle, bytearray(packet))
+
+def Install(pepperoni, modules):
+  #routes pepperoni's BLE calls to the simulated modules
+  SimScanner.modules = modules
+  pepperoni.BleakScanner = SimScanner
+  pepperoni.BleakClient = SimClient
+
+def MakeModules(count:int, sessionCount:int, link:SimLink, stats:SimStats, **options):
+  modules = []
+  for i in range(count):
+    module = SimModule("peppe{0:03d}".format(i), "SIM:00:00:00:{0:02X}:{1:02X}".format(i >> 8, i & 0xff), link, stats, **options)
+    module.AddSessions(sessionCount, dataId=i)
+    modules.append(module)
+  return modules
+
+#usage: blesim.py [command]...
+#runs commands against one simulated module and prints the notifications
+if __name__ == "__main__":
+  async def Main(commands):
+    stats = SimStats()
+    module = MakeModules(1, 4, SimLink(packetInterval=0), stats)[0]
+    async with SimClient(SimDevice(module)) as client:
+      await client.start_notify(charHandle, lambda sender, data: sys.stdout.write(data.decode()))
+      for command in commands:
+        await client.write_gatt_char(charHandle, ("gjcommand:" + command).encode())
+        await client.responder
+    print()
+
+  asyncio.run(Main(sys.argv[1:] or ["version", "batt", "turndata disp 0"]))
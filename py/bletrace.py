@@ -0,0 +1,135 @@
+import os
+import sys
+import time
+import struct
+from collections import deque
+from datetime import datetime
+from sessionstore import ParseSession, DecodeSessionFrame, AtomicWrite, framePrefix
+
+#bounded in-memory trace of the raw BLE traffic of every module.
+#recording is a tuple appended to a deque, nothing is formatted or printed
+#on the notification path. the trace of a module is dumped to a binary
+#file when its connection fails, this script decodes and replays it
+
+traceConnect = 1
+traceWrite = 2
+traceNotify = 3
+traceDisconnect = 4
+traceError = 5
+
+kindNames = {traceConnect : "connect", traceWrite : "write", traceNotify : "notify",
+  traceDisconnect : "disconnect", traceError : "error"}
+
+#file: magic, version then one record per event:
+#unixtime, kind, device name length, data length, device name, data
+fileHeaderStruct = struct.Struct("<4sH")
+fileMagic = b"PPTR"
+fileVersion = 1
+eventStruct = struct.Struct("<dBBH")
+
+class TraceBuffer:
+  def __init__(self, size:int = 8192):
+    #oldest events are dropped once 'size' are held
+    self.events = deque(maxlen=size)
+
+  def Add(self, kind:int, device:str, data:bytes = b""):
+    self.events.append((time.time(), kind, device, data))
+
+  def GetEvents(self, device:str = None):
+    return [event for event in list(self.events) if device is None or event[2] == device]
+
+  def Dump(self, filepath:str, device:str = None):
+    #returns the number of events written
+    events = self.GetEvents(device)
+    WriteTrace(filepath, events)
+    return len(events)
+
+def WriteTrace(filepath:str, events):
+  with AtomicWrite(filepath, "wb") as file:
+    file.write(fileHeaderStruct.pack(fileMagic, fileVersion))
+    for eventTime, kind, device, data in events:
+      name = device.encode()[:255]
+      data = bytes(data[:0xffff])
+      file.write(eventStruct.pack(eventTime, kind, len(name), len(data)))
+      file.write(name)
+      file.write(data)
+
+def ReadTrace(filepath:str):
+  #returns the events, (unixtime, kind, device, data), a truncated last event is dropped
+  with open(filepath, "rb") as file:
+    content = file.read()
+
+  magic, version = fileHeaderStruct.unpack_from(content)
+  if magic != fileMagic or version != fileVersion:
+    raise ValueError("{0} is not a trace file".format(filepath))
+
+  events = []
+  offset = fileHeaderStruct.size
+  while offset + eventStruct.size <= len(content):
+    eventTime, kind, nameLength, dataLength = eventStruct.unpack_from(content, offset)
+    offset += eventStruct.size
+    if offset + nameLength + dataLength > len(content):
+      break
+    device = content[offset:offset + nameLength].decode(errors="replace")
+    offset += nameLength
+    events.append((eventTime, kind, device, content[offset:offset + dataLength]))
+    offset += dataLength
+  return events
+
+def PruneTraces(directory:str, keepCount:int):
+  #keeps the newest trace files
+  filepaths = [os.path.join(directory, name) for name in os.listdir(directory) if name.endswith(".trace")]
+  filepaths.sort(key=os.path.getmtime)
+  for filepath in filepaths[:max(len(filepaths) - keepCount, 0)]:
+    os.remove(filepath)
+
+def PrintTrace(events):
+  for eventTime, kind, device, data in events:
+    stamp = datetime.fromtimestamp(eventTime).strftime('%Y-%m-%d %H:%M:%S.%f')
+    print("{0} {1} {2:<10} {3:>4} {4!r}".format(stamp, device, kindNames.get(kind, kind), len(data), bytes(data)))
+
+def ReplayTrace(events):
+  #feeds the notifications through the gateway's line framer and session
+  #parsers, one framer per connection as in ConnectionSession, and prints
+  #what the gateway made of them
+  from pepperoni import LineFramer
+
+  totals = {"sessions" : 0, "invalid" : 0, "other" : 0}
+  framers = {}
+  for eventTime, kind, device, data in events:
+    if kind == traceNotify:
+      for line in framers.setdefault(device, LineFramer()).Feed(data):
+        if line.startswith("id:") or line.startswith(framePrefix):
+          try:
+            record = ParseSession(line) if line.startswith("id:") else DecodeSessionFrame(line)
+            totals["sessions"] += 1
+            print("{0}   session {1}".format(device, record.ToLine()))
+          except ValueError as e:
+            totals["invalid"] += 1
+            print("{0}   INVALID '{1}' ({2})".format(device, line, e))
+        else:
+          totals["other"] += 1
+          print("{0}   {1}".format(device, line))
+      continue
+
+    if kind == traceConnect:
+      framers[device] = LineFramer()
+    prefix = ">" if kind == traceWrite else "# " + kindNames.get(kind, str(kind))
+    print("{0} {1} {2}".format(device, prefix, bytes(data).decode(errors="replace")).rstrip())
+
+  print("sessions:{0} invalid:{1} other lines:{2}".format(totals["sessions"], totals["invalid"], totals["other"]))
+
+#usage:
+#  bletrace.py decode <file.trace>    prints every event
+#  bletrace.py replay <file.trace>    runs the notifications through the gateway parsers
+if __name__ == "__main__":
+  argv = sys.argv
+
+  if len(argv) >= 3 and argv[1] == "decode":
+    PrintTrace(ReadTrace(argv[2]))
+
+  elif len(argv) >= 3 and argv[1] == "replay":
+    ReplayTrace(ReadTrace(argv[2]))
+
+  else:
+    print("usage: bletrace.py decode <file.trace> | replay <file.trace>")
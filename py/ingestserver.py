@@ -0,0 +1,203 @@
+import sys
+import ssl
+import time
+import random
+import threading
+import urllib.parse
+import http.server
+from sessionstore import ParseSession
+from uploadcodec import DecodeSessions
+
+#local stand-in for the ingest server, same form contract as the real one:
+#  POST /pepperoni/        mod, cnt, prd, time, readings    one session
+#                          mod, batt                        battery level
+#  POST /pepperoni/batch/  mod, sessions                    session lines, one per line
+#  POST /pepperoni/packed/?mod=                             gzipped uploadcodec payload
+#latency, error rate and the batch and packed endpoints are configurable so the
+#gateway's upload path can be measured without touching production
+
+class IngestHandler(http.server.BaseHTTPRequestHandler):
+  protocol_version = "HTTP/1.1"
+  #headers and body are separate writes, without it every response waits on a delayed ack
+  disable_nagle_algorithm = True
+
+  def do_POST(self):
+    server = self.server
+    size = int(self.headers.get("Content-Length", 0))
+    body = self.rfile.read(size)
+    server.Count("bytes", size)
+    path = urllib.parse.urlsplit(self.path).path
+
+    if server.latency > 0 or server.jitter > 0:
+      time.sleep(server.latency + random.uniform(0, server.jitter))
+
+    if random.random() < server.errorRate:
+      server.Count("errors")
+      return self.Reply(503, "unavailable")
+
+    if path == "/pepperoni/packed/" and server.packed:
+      status = self.ReceivePacked(body)
+    elif path == "/pepperoni/batch/" and server.batch:
+      status = self.ReceiveBatch(ParseForm(body))
+    elif path == "/pepperoni/":
+      status = self.ReceiveSession(ParseForm(body))
+    else:
+      status = 404
+
+    self.Reply(status, "ok" if status == 200 else "error")
+
+  def ReceiveSession(self, fields):
+    mod = GetField(fields, "mod")
+    if mod is None:
+      return 400
+
+    if "batt" in fields:
+      self.server.Count("batt")
+      self.server.batt[mod] = GetField(fields, "batt")
+      return 200
+
+    values = [GetField(fields, name) for name in ("cnt", "prd", "time", "readings")]
+    if None in values:
+      return 400
+
+    try:
+      line = "id:{0} t:{1} p:{2} {3}".format(values[0], values[2], values[1], values[3].replace(",", " "))
+      self.server.Store(mod, [ParseSession(line)])
+    except ValueError:
+      return 400
+    return 200
+
+  def ReceiveBatch(self, fields):
+    mod = GetField(fields, "mod")
+    sessions = GetField(fields, "sessions")
+    if mod is None or sessions is None:
+      return 400
+
+    try:
+      self.server.Store(mod, [ParseSession(line) for line in sessions.splitlines() if line.strip()])
+    except ValueError:
+      return 400
+    return 200
+
+  def ReceivePacked(self, body:bytes):
+    if self.headers.get("Content-Type", "").split(";")[0] != "application/vnd.pepperoni.sessions":
+      return 415
+
+    mod = GetField(urllib.parse.parse_qs(urllib.parse.urlsplit(self.path).query), "mod")
+    try:
+      deviceName, records = DecodeSessions(body)
+    except ValueError:
+      return 400
+    if mod is not None and mod != deviceName:
+      return 400
+
+    self.server.Store(deviceName, records)
+    return 200
+
+  def Reply(self, status:int, body:str):
+    self.server.Count(status)
+    data = body.encode()
+    self.send_response(status)
+    self.send_header("Content-Type", "text/plain")
+    self.send_header("Content-Length", str(len(data)))
+    self.end_headers()
+    self.wfile.write(data)
+
+  def log_message(self, format, *args):
+    if self.server.verbose:
+      super().log_message(format, *args)
+
+def ParseForm(body:bytes):
+  return urllib.parse.parse_qs(body.decode(), keep_blank_values=True)
+
+def GetField(fields, name:str):
+  values = fields.get(name)
+  return values[0] if values else None
+
+class IngestServer(http.server.ThreadingHTTPServer):
+  daemon_threads = True
+
+  def __init__(self, host:str = "127.0.0.1", port:int = 0, latency:float = 0, jitter:float = 0,
+    errorRate:float = 0, batch:bool = True, certfile:str = None, keyfile:str = None, outFilepath:str = None, packed:bool = True):
+    super().__init__((host, port), IngestHandler)
+    self.latency = latency        #seconds added to every request
+    self.jitter = jitter          #random extra latency, up to this many seconds
+    self.errorRate = errorRate    #requests answered 503
+    self.batch = batch            #without it /pepperoni/batch/ answers 404
+    self.packed = packed          #same for /pepperoni/packed/
+    self.verbose = False
+    self.lock = threading.Lock()
+    self.counts = {}
+    self.received = {}            #(mod, session time) -> first receipt, time.monotonic()
+    self.duplicates = 0
+    self.batt = {}
+    self.out = open(outFilepath, "a") if outFilepath else None
+    self.thread = None
+
+    self.scheme = "http"
+    if certfile is not None:
+      context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+      context.load_cert_chain(certfile, keyfile)
+      self.socket = context.wrap_socket(self.socket, server_side=True)
+      self.scheme = "https"
+
+  def GetUrl(self):
+    host, port = self.server_address[:2]
+    return "{0}://{1}:{2}".format(self.scheme, host, port)
+
+  def Count(self, key, value:int = 1):
+    with self.lock:
+      self.counts[key] = self.counts.get(key, 0) + value
+
+  def Store(self, mod:str, records):
+    now = time.monotonic()
+    with self.lock:
+      for record in records:
+        key = (mod, record.time)
+        if key in self.received:
+          self.duplicates += 1
+          continue
+        self.received[key] = now
+        if self.out is not None:
+          self.out.write(mod + " " + record.ToLine() + "\n")
+
+  def Start(self):
+    #serves on a background thread
+    self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+    self.thread.start()
+    return self
+
+  def Stop(self):
+    self.shutdown()
+    self.server_close()
+    if self.out is not None:
+      self.out.close()
+
+#usage: ingestserver.py [port=8080] [latency=S] [jitter=S] [errors=RATE] [nobatch] [nopacked]
+#  [cert=server.pem key=server.key] [out=received.txt] [verbose]
+#a self signed certificate for https:
+#  openssl req -x509 -newkey rsa:2048 -nodes -days 365 -subj /CN=localhost -keyout server.key -out server.pem
+#then run the gateway with server=https://localhost:8080 cafile=server.pem
+if __name__ == "__main__":
+  argv = sys.argv
+
+  def GetArgValue(name:str, default):
+    prefix = name + "="
+    for arg in argv:
+      if arg.startswith(prefix):
+        return arg[len(prefix):]
+    return default
+
+  server = IngestServer("0.0.0.0", int(GetArgValue("port", 8080)),
+    float(GetArgValue("latency", 0)), float(GetArgValue("jitter", 0)), float(GetArgValue("errors", 0)),
+    "nobatch" not in argv, GetArgValue("cert", None), GetArgValue("key", None), GetArgValue("out", None), "nopacked" not in argv)
+  server.verbose = "verbose" in argv
+  print("ingest server on port {0} ({1})".format(server.server_address[1], server.scheme))
+
+  try:
+    server.Start()
+    while True:
+      time.sleep(10)
+      print("sessions:{0} duplicates:{1} responses:{2}".format(len(server.received), server.duplicates, server.counts))
+  except KeyboardInterrupt:
+    server.Stop()
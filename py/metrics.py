@@ -0,0 +1,169 @@
+import json
+import time
+import bisect
+import threading
+import http.server
+from sessionstore import AtomicWrite
+
+#gateway instrumentation: counters and histograms, one series per label
+#set (usually the device). read as prometheus text on /metrics or as a
+#json snapshot written every few seconds
+
+#seconds, for scan, connect, discovery and http latency
+timeBuckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+#per second, for transfer throughput
+rateBuckets = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000, 20000, 50000)
+
+class Histogram:
+  #cumulative on export like a prometheus histogram, the last count is +Inf
+  __slots__ = ("buckets", "counts", "sum", "count")
+
+  def __init__(self, buckets):
+    self.buckets = buckets
+    self.counts = [0] * (len(buckets) + 1)
+    self.sum = 0
+    self.count = 0
+
+  def Observe(self, value:float):
+    self.counts[bisect.bisect_left(self.buckets, value)] += 1
+    self.sum += value
+    self.count += 1
+
+  def GetPercentile(self, percent:float):
+    #upper bound of the bucket holding the percentile, None above the last bucket
+    rank = self.count * percent / 100
+    total = 0
+    for i in range(len(self.buckets)):
+      total += self.counts[i]
+      if total >= rank:
+        return self.buckets[i]
+    return None
+
+class Metrics:
+  #thread safe, uploads are observed from the upload threads
+  def __init__(self):
+    self.lock = threading.Lock()
+    self.definitions = {}   #name -> (kind, help, buckets)
+    self.counters = {}      #(name, labels) -> value
+    self.histograms = {}    #(name, labels) -> Histogram
+    self.startTime = time.time()
+
+  def Describe(self, name:str, kind:str, help:str, buckets=None):
+    #kind is "counter" or "histogram"
+    self.definitions[name] = (kind, help, buckets)
+
+  def Add(self, name:str, value:float = 1, **labels):
+    key = (name, tuple(sorted(labels.items())))
+    with self.lock:
+      self.counters[key] = self.counters.get(key, 0) + value
+
+  def Observe(self, name:str, value:float, **labels):
+    key = (name, tuple(sorted(labels.items())))
+    with self.lock:
+      histogram = self.histograms.get(key)
+      if histogram is None:
+        histogram = Histogram(self.definitions[name][2] or timeBuckets)
+        self.histograms[key] = histogram
+      histogram.Observe(value)
+
+  def Reset(self):
+    with self.lock:
+      self.counters = {}
+      self.histograms = {}
+      self.startTime = time.time()
+
+  def GetPrometheusText(self):
+    lines = []
+    with self.lock:
+      for name, (kind, help, buckets) in sorted(self.definitions.items()):
+        lines.append("# HELP {0} {1}".format(name, help))
+        lines.append("# TYPE {0} {1}".format(name, kind))
+
+        if kind == "counter":
+          for (seriesName, labels), value in sorted(self.counters.items()):
+            if seriesName == name:
+              lines.append("{0}{1} {2}".format(name, FormatLabels(labels), FormatValue(value)))
+          continue
+
+        for (seriesName, labels), histogram in sorted(self.histograms.items()):
+          if seriesName != name:
+            continue
+          total = 0
+          for bound, count in zip(histogram.buckets + ("+Inf",), histogram.counts):
+            total += count
+            lines.append("{0}_bucket{1} {2}".format(name, FormatLabels(labels + (("le", FormatValue(bound)),)), total))
+          lines.append("{0}_sum{1} {2}".format(name, FormatLabels(labels), FormatValue(histogram.sum)))
+          lines.append("{0}_count{1} {2}".format(name, FormatLabels(labels), histogram.count))
+
+    return "\n".join(lines) + "\n"
+
+  def GetSnapshot(self):
+    #counters and histogram summaries, series keyed "name{labels}"
+    snapshot = {"time" : time.time(), "uptime" : time.time() - self.startTime, "counters" : {}, "histograms" : {}}
+    with self.lock:
+      for (name, labels), value in sorted(self.counters.items()):
+        snapshot["counters"][name + FormatLabels(labels)] = value
+
+      for (name, labels), histogram in sorted(self.histograms.items()):
+        snapshot["histograms"][name + FormatLabels(labels)] = {
+          "count" : histogram.count,
+          "sum" : histogram.sum,
+          "mean" : histogram.sum / histogram.count if histogram.count else 0,
+          "p50" : histogram.GetPercentile(50),
+          "p95" : histogram.GetPercentile(95),
+          "buckets" : dict(zip([FormatValue(bound) for bound in histogram.buckets] + ["+Inf"], histogram.counts)) }
+    return snapshot
+
+  def WriteJson(self, filepath:str):
+    #a reader never sees a partial file
+    with AtomicWrite(filepath) as file:
+      json.dump(self.GetSnapshot(), file, indent=1)
+
+def FormatLabels(labels):
+  if len(labels) == 0:
+    return ""
+  return "{" + ",".join('{0}="{1}"'.format(key, str(value).replace("\\", "\\\\").replace('"', '\\"')) for key, value in labels) + "}"
+
+def FormatValue(value):
+  if isinstance(value, float) and value.is_integer():
+    return str(int(value))
+  return str(value)
+
+class MetricsHandler(http.server.BaseHTTPRequestHandler):
+  def do_GET(self):
+    if self.path.split("?")[0] == "/metrics":
+      data = self.server.metrics.GetPrometheusText().encode()
+      contentType = "text/plain; version=0.0.4"
+    elif self.path.split("?")[0] == "/metrics.json":
+      data = json.dumps(self.server.metrics.GetSnapshot(), indent=1).encode()
+      contentType = "application/json"
+    else:
+      self.send_error(404)
+      return
+
+    self.send_response(200)
+    self.send_header("Content-Type", contentType)
+    self.send_header("Content-Length", str(len(data)))
+    self.end_headers()
+    self.wfile.write(data)
+
+  def log_message(self, format, *args):
+    pass
+
+class MetricsServer(http.server.ThreadingHTTPServer):
+  #serves /metrics and /metrics.json on a background thread
+  daemon_threads = True
+
+  def __init__(self, metrics:Metrics, host:str = "127.0.0.1", port:int = 9100):
+    super().__init__((host, port), MetricsHandler)
+    self.metrics = metrics
+    self.thread = None
+
+  def Start(self):
+    self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+    self.thread.start()
+    return self
+
+  def Stop(self):
+    self.shutdown()
+    self.server_close()
@@ -5,14 +5,29 @@ from bleak import BleakScanner
 from bleak import BleakClient
 from bleak.backends.device import BLEDevice
 from bleak.backends.scanner import AdvertisementData
+import codecs
 import logging
 import traceback
-import urllib.request
+import urllib.parse
+import http.client
 import ssl
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 import time
 import os
+import json
+import random
+import heapq
+import math
+import struct
+import sqlite3
 from pathlib import Path
+from sessionstore import SessionStore, SessionRecord, AtomicWrite, ParseSession, DecodeSessionFrame, IsSessionFragment, framePrefix, maxValues
+from uploadcodec import EncodeSessions, contentType as packedContentType
+from metrics import Metrics, MetricsServer, rateBuckets
+from profiler import GatewayProfiler
+from bletrace import TraceBuffer, PruneTraces, traceConnect, traceWrite, traceNotify, traceDisconnect, traceError
 
 logging.basicConfig()
 
@@ -38,243 +53,840 @@ def GetUnixtime():
   unixtime = time.mktime(ct.timetuple())
   return unixtime
 
-def GetSessionTime(t):
-  def GetVarValue(t):
-    words = t.split(":")
-    return words[1]
-
-  words = t.split(" ")
-
-  time = GetVarValue(words[1])
-
-  return int(time)
-
-def GetSessionPeriod(t):
-  def GetVarValue(t):
-    words = t.split(":")
-    return words[1]
-
-  words = t.split(" ")
-
-  AddDebugLog("Session period {0}".format(words[2]))
-
-  period = GetVarValue(words[2])
+#where each connection window is spent, per device. served as prometheus
+#text with metrics=[HOST:]PORT, written as json with metricsfile=F
+metrics = Metrics()
+metrics.Describe("pepperoni_scan_seconds", "histogram", "Wait for the first advert of a module")
+metrics.Describe("pepperoni_scan_failures_total", "counter", "Module searches that timed out")
+metrics.Describe("pepperoni_link_wait_seconds", "histogram", "Wait for a free adapter link")
+metrics.Describe("pepperoni_connect_seconds", "histogram", "BLE connection setup")
+metrics.Describe("pepperoni_discovery_seconds", "histogram", "Command characteristic lookup and notify subscription")
+metrics.Describe("pepperoni_connection_seconds", "histogram", "Connection held, from connect to disconnect")
+metrics.Describe("pepperoni_connect_errors_total", "counter", "Connection attempts that raised")
+metrics.Describe("pepperoni_transfer_seconds", "histogram", "turndata dump, all resumes included")
+metrics.Describe("pepperoni_transfer_sessions_per_second", "histogram", "Sessions received per second of dump", rateBuckets)
+metrics.Describe("pepperoni_transfer_bytes_per_second", "histogram", "Notification bytes received per second of dump", rateBuckets)
+metrics.Describe("pepperoni_transfer_sessions_total", "counter", "Sessions received")
+metrics.Describe("pepperoni_transfer_bytes_total", "counter", "Notification bytes received during dumps")
+metrics.Describe("pepperoni_transfer_resumes_total", "counter", "Dumps resumed after a cut off")
+metrics.Describe("pepperoni_http_request_seconds", "histogram", "Server request latency")
+metrics.Describe("pepperoni_http_request_bytes_total", "counter", "Server request body bytes")
+metrics.Describe("pepperoni_http_errors_total", "counter", "Server requests failed, status none when unreachable")
+metrics.Describe("pepperoni_http_retries_total", "counter", "Requests sent again after a dropped kept-alive connection")
+metrics.Describe("pepperoni_connection_failures_total", "counter", "Device reads failed, planned again by the retry policy")
+metrics.Describe("pepperoni_parked_total", "counter", "Devices parked by the circuit breaker")
+metrics.Describe("pepperoni_upload_retries_total", "counter", "Sessions postponed after a failed upload")
+metrics.Describe("pepperoni_clock_syncs_total", "counter", "unixtime commands sent")
+metrics.Describe("pepperoni_clock_syncs_skipped_total", "counter", "Connections without unixtime, module clock predicted accurate")
+metrics.Describe("pepperoni_clock_offset_seconds", "histogram", "Module clock offset measured from adverts")
+
+#one ssl context for the process and one kept-alive connection per
+#upload thread and server, instead of a new handshake for every request
+sslContext = ssl.create_default_context()
+httpConnections = threading.local()
+
+def GetServerConnection(netloc:str, scheme:str):
+  pool = getattr(httpConnections, "pool", None)
+  if pool is None:
+    pool = {}
+    httpConnections.pool = pool
+
+  connection = pool.get(netloc)
+  if connection is None:
+    if scheme == "https":
+      connection = http.client.HTTPSConnection(netloc, timeout=30, context=sslContext)
+    else:
+      connection = http.client.HTTPConnection(netloc, timeout=30)
+    pool[netloc] = connection
 
-  return int(period)
+  return connection
 
-def GetSessionValueCount(t):
-  def GetVarValue(t):
-    words = t.split(":")
-    return words[1]
+def CloseServerConnection(netloc:str):
+  pool = getattr(httpConnections, "pool", {})
+  connection = pool.pop(netloc, None)
+  if connection is not None:
+    connection.close()
 
-  words = t.split(" ")
-  return len(words) - 3
- 
-def SendServerRequest(server, url, urlParams):
+#returns the http status, None when the server could not be reached.
+#urlParams are form encoded, or go in the query string when a body is given
+def SendServerRequest(server, url, urlParams, body:bytes = None, contentType:str = None):
 
-  url = server + url
+  serverUrl = urllib.parse.urlsplit(server)
+  path = serverUrl.path + url
 
   headers = {
     'User-Agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10.15; rv:78.0) Gecko/20100101 Firefox/78.0',
     'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,image/webp,*/*;q=0.8',
-    'Content-Type': 'application/x-www-form-urlencoded'
-
+    'Content-Type': 'application/x-www-form-urlencoded',
+    'Connection': 'keep-alive'
   }
 
+  device = urlParams.get('mod', "")
   urlParams = urllib.parse.urlencode(urlParams)
   data = urlParams.encode('ascii') # data should be bytes
-  req = urllib.request.Request(url, data, headers)
-
-  AddLog(req.full_url +urlParams)
-  
-  context = ssl.create_default_context()
-
-  try:
-    opener = urllib.request.build_opener(urllib.request.HTTPHandler(debuglevel=0))
-    urllib.request.install_opener(opener)
-    with opener.open(req) as r:
-      AddLog(r.read(100))
-        
-  except Exception as e:
-    AddLog("http error")
-    AddLog(req.header_items())
-    if hasattr(e, 'code'):
-      AddLog(e.code)
-    if hasattr(e, 'reason'):
-      AddLog(e.reason)
-    if hasattr(e, 'headers'):
-      AddLog(e.headers)
-
-
-def SendTempSession(server, deviceName, t):
-  def GetVarValue(t):
-    words = t.split(":")
-    return words[1]
-
-  words = t.split(" ")
-
-  cnt = GetVarValue(words[0])
-  time = GetVarValue(words[1])
-  period = GetVarValue(words[2])
-  chunk = ",".join(words[3:len(words)])
-  
-  url = server + "/pepperoni/"
 
+  if body is not None:
+    path += "?" + urlParams
+    data = body
+    headers['Content-Type'] = contentType
+
+  AddLog(server + url + urlParams[:200] + ("" if body is None else " ({0} bytes)".format(len(body))))
+  metrics.Add("pepperoni_http_request_bytes_total", len(data), device=device)
+
+  begin = time.perf_counter()
+  status = PostServerRequest(serverUrl, path, data, headers, device)
+  metrics.Observe("pepperoni_http_request_seconds", time.perf_counter() - begin, device=device)
+  if status is None or status >= 400:
+    metrics.Add("pepperoni_http_errors_total", device=device, status=str(status).lower())
+  return status
+
+def PostServerRequest(serverUrl, path:str, data:bytes, headers, device:str):
+  for attempt in range(2):
+    connection = GetServerConnection(serverUrl.netloc, serverUrl.scheme)
+    reused = connection.sock is not None
+
+    try:
+      connection.request("POST", path, data, headers)
+      with connection.getresponse() as r:
+        body = r.read()
+        if r.status >= 400:
+          AddLog("http error")
+          AddLog(r.status)
+          AddLog(r.reason)
+          AddLog(r.headers)
+        else:
+          AddLog(body[:100])
+        if r.will_close:
+          CloseServerConnection(serverUrl.netloc)
+        return r.status
+
+    except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError) as e:
+      CloseServerConnection(serverUrl.netloc)
+      #the server dropped an idle kept-alive connection, retry on a new one
+      if reused and attempt == 0:
+        metrics.Add("pepperoni_http_retries_total", device=device)
+        continue
+      AddLog("http error")
+      AddLog(e)
+      return None
+
+    except Exception as e:
+      CloseServerConnection(serverUrl.netloc)
+      AddLog("http error")
+      AddLog(e)
+      return None
+
+class UploadService:
+  #http requests are blocking, they run on a small thread pool fed by
+  #a bounded queue so server latency never stalls the BLE event loop
+  def __init__(self, server:str, workerCount:int = 2, queueSize:int = 1024):
+    self.server = server
+    self.batchSize = 1
+    self.flushInterval = 5
+    self.batchSupported = True
+    self.packedSupported = True
+    self.workerCount = workerCount
+    self.requests = asyncio.Queue(queueSize)
+    self.executor = None
+    self.workers = []
+
+  def Start(self):
+    self.executor = ThreadPoolExecutor(self.workerCount, "upload")
+    for i in range(self.workerCount):
+      self.workers.append(asyncio.create_task(self.Worker()))
+
+  async def Stop(self):
+    for worker in self.workers:
+      worker.cancel()
+    self.workers = []
+    self.executor.shutdown(wait=False)
+
+  async def Post(self, url:str, urlParams, body:bytes = None, contentType:str = None):
+    #returns once the request is queued, the future holds its result
+    future = asyncio.get_running_loop().create_future()
+    await self.requests.put((url, urlParams, body, contentType, future))
+    return future
+
+  async def Send(self, url:str, urlParams, body:bytes = None, contentType:str = None):
+    future = await self.Post(url, urlParams, body, contentType)
+    return await future
+
+  async def Worker(self):
+    loop = asyncio.get_running_loop()
+    while True:
+      url, urlParams, body, contentType, future = await self.requests.get()
+      try:
+        result = await loop.run_in_executor(self.executor, SendServerRequest, self.server, url, urlParams, body, contentType)
+      except Exception as e:
+        if not future.done():
+          future.set_exception(e)
+        continue
+      #the caller may have been cancelled while the request ran
+      if not future.done():
+        future.set_result(result)
+
+async def SendTempSession(uploader:UploadService, deviceName, record:SessionRecord):
   urlParams = {
     'mod' : deviceName,
-    'cnt' : cnt,
-    'prd' : period,
-    'time' : time,
-    'readings' : chunk }
+    'cnt' : record.id,
+    'prd' : record.period,
+    'time' : record.time,
+    'readings' : ",".join(map(str, record.values)) }
+
+  return await uploader.Send("/pepperoni/", urlParams)
+
+#the server has no such endpoint. any other refusal (ie: 400 on a bad
+#line) is a failed batch, the outbox sends it again
+batchNotSupportedStatus = (404, 405, 501)
+packedNotSupportedStatus = (404, 405, 415)
+
+def IsAcknowledged(status):
+  return status is not None and status >= 200 and status < 300
+
+async def SendTempSessions(uploader:UploadService, deviceName, sessions):
+  #returns how many sessions, in order, the server acknowledged.
+  #several sessions per request when the server has the packed or batch
+  #endpoint, the packed one is about 10 times smaller, see uploadcodec.py
+  if len(sessions) > 1 and uploader.packedSupported:
+    payload = EncodeSessions(deviceName, sessions)
+    status = await uploader.Send("/pepperoni/packed/", {'mod' : deviceName}, payload, packedContentType)
+    if IsAcknowledged(status):
+      return len(sessions)
+    if status not in packedNotSupportedStatus:
+      return 0
+
+    uploader.packedSupported = False
+    AddLog("Server has no packed upload, sending text batches")
+
+  if len(sessions) > 1 and uploader.batchSupported:
+    urlParams = {
+      'mod' : deviceName,
+      'sessions' : "\n".join(record.ToLine() for record in sessions) }
+
+    status = await uploader.Send("/pepperoni/batch/", urlParams)
+    if IsAcknowledged(status):
+      return len(sessions)
+    if status not in batchNotSupportedStatus:
+      return 0
+
+    uploader.batchSupported = False
+    AddLog("Server has no batch upload, sending single sessions")
+
+  for i in range(len(sessions)):
+    status = await SendTempSession(uploader, deviceName, sessions[i])
+    if IsAcknowledged(status) == False:
+      return i
+
+  return len(sessions)
+
+writeServiceUuid = "000000ee-0000-1000-8000-00805f9b34fb"
+writeCharUuid = "0000ee01-0000-1000-8000-00805f9b34fb"
+
+class LineFramer:
+  #turns notification packets into text lines.
+  #a packet can hold several lines or a part of one, partial lines are
+  #kept until the rest arrives. the module ends lines with "\n" or "\n\r"
+  def __init__(self):
+    self.buffer = bytearray()
+    self.decoder = codecs.getincrementaldecoder("utf-8")("replace")
+
+  def Feed(self, data):
+    lines = []
+    buffer = self.buffer
+    scanFrom = len(buffer)  #bytes already in the buffer hold no newline
+    buffer += data
+
+    start = 0
+    pos = buffer.find(b"\n", scanFrom)
+    with memoryview(buffer) as view:
+      while pos != -1:
+        line = self.decoder.decode(view[start:pos], True).strip("\r")
+        if len(line):
+          lines.append(line)
+        start = pos + 1
+        pos = buffer.find(b"\n", start)
+
+    if start != 0:
+      del buffer[:start]
+
+    return lines
+
+class PendingCommand:
+  #a queued gjcommand, its future resolves with the received text once
+  #a terminator line arrives or after 'timeout' ms without data, 'firstTimeout'
+  #ms when set and nothing was received yet.
+  #'terminator' is a string or a tuple of strings.
+  #lines go to 'onReceive' when set instead of being accumulated.
+  #'cmd' can be a coroutine function, awaited for the text right before the write
+  def __init__(self, cmd, terminator, timeout, onReceive, firstTimeout = None):
+    self.cmd = cmd
+    self.terminator = (terminator,) if isinstance(terminator, str) else terminator
+    self.timeout = timeout
+    self.firstTimeout = firstTimeout
+    self.responded = False
+    self.onReceive = onReceive
+    self.lines = []
+    self.lastReceived = 0
+    self.sentTime = None   #time.monotonic() of the write, until the first response
+    self.future = asyncio.get_running_loop().create_future()
+
+  def OnLine(self, line:str):
+    if self.onReceive is not None:
+      self.onReceive(line)
+    else:
+      self.lines.append(line)
+
+    if self.terminator is None or any(line.find(terminator) != -1 for terminator in self.terminator):
+      #without a terminator the first line completes the command
+      self.Complete()
+
+  def Complete(self):
+    if self.future.done() == False:
+      self.future.set_result("\n".join(self.lines))
+
+class ConnectionSession:
+  #one per BLE connection: resolves the command characteristic once,
+  #keeps a single notify subscription and runs queued commands in order
+  def __init__(self, instance, client):
+    self.instance = instance
+    self.client = client
+    self.char = None
+    self.framer = LineFramer()
+    self.current = None
+    self.commands = asyncio.Queue()
+    self.sender = None
+    self.bytesReceived = 0
+    self.trace = instance.gateway.trace
+    #shortest write to first response delay of the connection
+    self.minRtt = None
+
+  async def Open(self):
+    self.char = await self.GetWriteChar()
+    await self.client.start_notify(self.char, self.OnNotify)
+    self.sender = asyncio.create_task(self.SendLoop())
+
+  async def Close(self):
+    self.sender.cancel()
+    self.FailPending(ConnectionError("Session closed"))
+    if self.minRtt is not None:
+      self.instance.clock.OnRtt(self.minRtt)
+    try:
+      await self.client.stop_notify(self.char)
+    except Exception as e:
+      #the link may already be gone
+      AddDebugLog("stop_notify failed: {0}".format(e))
+
+  async def GetWriteChar(self):
+    #characteristic handles don't change between connections,
+    #skip service discovery lookups once a handle is known
+    handleCache = self.instance.gateway.charHandleCache
+    handle = handleCache.get(self.instance.address)
+    if handle is not None:
+      return handle
+
+    svcs = await self.client.get_services()
+
+    writeChar = None
+    writeSrv = svcs.get_service(writeServiceUuid)
+    if writeSrv is not None:
+      writeChar = writeSrv.get_characteristic(writeCharUuid)
+
+    if writeChar is None:
+      raise ValueError("Command characteristic not found")
+
+    handleCache[self.instance.address] = writeChar.handle
+    return writeChar.handle
+
+  def Command(self, cmd, terminator=None, timeout=1000, onReceive=None, firstTimeout=None):
+    command = PendingCommand(cmd, terminator, timeout, onReceive, firstTimeout)
+    self.commands.put_nowait(command)
+    return command.future
+
+  async def Run(self, cmd, terminator=None, timeout=1000, onReceive=None):
+    return await self.Command(cmd, terminator, timeout, onReceive)
+
+  async def SendLoop(self):
+    #the module handles one command at a time, the next one is written
+    #as soon as the previous one completes
+    while True:
+      command = await self.commands.get()
+      self.current = command
 
-  SendServerRequest(server, "/pepperoni/", urlParams)
+      try:
+        if callable(command.cmd):
+          command.cmd = await command.cmd()
+
+        command.lastReceived = GetElapsedMillis()
+        AddLog("Begin command {0}".format(command.lastReceived))
+
+        command.sentTime = time.monotonic()
+        await SendCommand(self.instance, self, command.cmd)
+        await self.WaitForCompletion(command)
+      except Exception as e:
+        if command.future.done() == False:
+          command.future.set_exception(e)
+
+      AddLog("End command {0}".format(GetElapsedMillis()))
+      self.current = None
+
+  async def WaitForCompletion(self, command:PendingCommand):
+    while command.future.done() == False:
+      timeout = command.timeout if command.responded or command.firstTimeout is None else command.firstTimeout
+      remaining = timeout - (GetElapsedMillis() - command.lastReceived)
+      if remaining <= 0:
+        AddDebugLog("Command '{0}' timed out".format(command.cmd))
+        command.Complete()
+        break
+      try:
+        await asyncio.wait_for(asyncio.shield(command.future), remaining / 1000)
+      except asyncio.TimeoutError:
+        pass
+
+  def FailPending(self, e:Exception):
+    commands = [self.current]
+    while self.commands.empty() == False:
+      commands.append(self.commands.get_nowait())
+    for command in commands:
+      if command is not None and command.future.done() == False:
+        command.future.set_exception(e)
+
+  def OnNotify(self, sender, data):
+    #hot path, the raw packet goes to the trace, nothing is formatted
+    self.trace.Add(traceNotify, self.instance.name, bytes(data))
+    self.bytesReceived += len(data)
+    lines = self.framer.Feed(data)
+
+    command = self.current
+    if command is None or command.future.done():
+      return
+
+    command.lastReceived = GetElapsedMillis()
+    if lines:
+      #the "\r" ending the previous command's reply isn't an answer
+      command.responded = True
+    if command.sentTime is not None:
+      rtt = time.monotonic() - command.sentTime
+      self.minRtt = rtt if self.minRtt is None else min(self.minRtt, rtt)
+      command.sentTime = None
+
+    if enableDebugLog:
+      AddDebugLog("Received @{1} ble data:'{0}'".format(data, command.lastReceived))
 
-  return int(time)
+    for line in lines:
+      command.OnLine(line)
+      if command.future.done():
+        break
 
-async def SendCommand(instance, client, char, cmd):
+async def SendCommand(instance, session, cmd):
   command = "gjcommand:" + cmd
   AddDebugLog("send command:" + command)
   encoded_string = command.encode()
+  session.trace.Add(traceWrite, instance.name, encoded_string)
   byte_array = bytearray(encoded_string)
-  await client.write_gatt_char(char, byte_array)
+  await session.client.write_gatt_char(session.char, byte_array)
+
+class SessionJournal:
+  #append-only file of received sessions not uploaded yet.
+  #fsync is batched every 'syncEvery' sessions and on close
+  def __init__(self, filepath:str, syncEvery:int = 32):
+    self.file = open(filepath, "a")
+    self.syncEvery = syncEvery
+    self.unsynced = 0
+
+  def Append(self, line:str):
+    self.file.write(line + "\n")
+    self.unsynced += 1
+    if self.unsynced >= self.syncEvery:
+      self.Sync()
+
+  def Sync(self):
+    self.file.flush()
+    os.fsync(self.file.fileno())
+    self.unsynced = 0
+
+  def Close(self):
+    self.Sync()
+    self.file.close()
+
+def ReplayJournal(instance):
+  #sessions left by a previous run were received but maybe not uploaded
+  if os.path.exists(instance.newReadingsFilepath) == False:
+    return
 
-async def SendCommandAndReceive(instance, client, char, cmd, timeout, clientOnReceive):
-  
-  done = False
-  received = ""
-  lastReceived = GetElapsedMillis()
+  with open(instance.newReadingsFilepath, "r") as journal:
+    for line in journal:
+      try:
+        instance.uploadQueue.put_nowait(ParseSession(line))
+      except ValueError:
+        pass
+
+  AddLog("Replaying {0} journaled sessions".format(instance.uploadQueue.qsize()))
+
+class SessionIndex:
+  #persistent index of the sessions already stored, keyed on
+  #(device, session id, session time) so the check doesn't load the history
+  #and a duplicate with a differently formatted line is still caught
+  def __init__(self, filepath:str):
+    self.db = sqlite3.connect(filepath)
+    self.db.execute("PRAGMA journal_mode=WAL")
+    self.db.execute("PRAGMA synchronous=NORMAL")
+    self.db.execute("""CREATE TABLE IF NOT EXISTS sessions (
+      device TEXT NOT NULL,
+      id INTEGER NOT NULL,
+      time INTEGER NOT NULL,
+      PRIMARY KEY (device, id, time)) WITHOUT ROWID""")
+    self.db.commit()
+
+  def Add(self, device:str, sessionId:int, sessionTime:int):
+    #returns True when the session was not indexed yet
+    cursor = self.db.execute("INSERT OR IGNORE INTO sessions VALUES (?, ?, ?)", (device, sessionId, sessionTime))
+    return cursor.rowcount == 1
+
+  def HasDevice(self, device:str):
+    cursor = self.db.execute("SELECT 1 FROM sessions WHERE device = ? LIMIT 1", (device,))
+    return cursor.fetchone() is not None
+
+  def ImportReadings(self, device:str, filepath:str):
+    #one time migration of a readings file written before the index existed
+    if self.HasDevice(device) or os.path.exists(filepath) == False:
+      return
 
-  AddLog("Begin command {0}".format(lastReceived))
+    count = 0
+    with open(filepath, "r") as readings:
+      for session in readings:
+        try:
+          record = ParseSession(session)
+          self.Add(device, record.id, record.time)
+          count += 1
+        except ValueError:
+          pass
+    self.Commit()
+    AddLog("Indexed {0} sessions from {1}".format(count, filepath))
+
+  def Commit(self):
+    self.db.commit()
+
+  def Close(self):
+    self.db.close()
+
+class UploadOutbox:
+  #sessions waiting for the server acknowledgement. rows stay in the
+  #database until acknowledged, failed sends are retried with exponential
+  #backoff and jitter, and a failure pauses the whole outbox so an outage
+  #doesn't turn into a retry storm
+  retryBaseDelay = 30
+  retryMaxDelay = 60 * 60
+
+  def __init__(self, db:sqlite3.Connection):
+    self.db = db
+    self.db.execute("""CREATE TABLE IF NOT EXISTS outbox (
+      device TEXT NOT NULL,
+      id INTEGER NOT NULL,
+      time INTEGER NOT NULL,
+      line TEXT NOT NULL,
+      created REAL NOT NULL,
+      attempts INTEGER NOT NULL DEFAULT 0,
+      nextAttempt REAL NOT NULL DEFAULT 0,
+      PRIMARY KEY (device, id, time)) WITHOUT ROWID""")
+    self.db.execute("CREATE INDEX IF NOT EXISTS outbox_next ON outbox (nextAttempt)")
+    #GetDue walks the oldest rows first, without them each call sorts the whole backlog
+    self.db.execute("CREATE INDEX IF NOT EXISTS outbox_created ON outbox (created)")
+    self.db.execute("CREATE INDEX IF NOT EXISTS outbox_device_created ON outbox (device, created, time)")
+    self.db.commit()
+    self.wakeEvent = asyncio.Event()
+    self.failures = 0
+    self.pausedUntil = 0
+
+  def Add(self, device:str, sessionId:int, sessionTime:int, line:str):
+    #committed by the caller along with the session index
+    self.db.execute("INSERT OR IGNORE INTO outbox (device, id, time, line, created) VALUES (?, ?, ?, ?, ?)",
+      (device, sessionId, sessionTime, line, time.time()))
+
+  def Wake(self):
+    self.wakeEvent.set()
+
+  def GetStats(self):
+    #pending session count and age in seconds of the oldest one
+    depth, oldest = self.db.execute("SELECT COUNT(*), MIN(created) FROM outbox").fetchone()
+    oldestAge = 0 if oldest is None else time.time() - oldest
+    return depth, oldestAge
+
+  def GetDue(self, now:float, limit:int):
+    #sessions of one device, oldest first. the unary + keeps sqlite from picking
+    #outbox_next, which would sort every due row to find the oldest one
+    row = self.db.execute("SELECT device FROM outbox WHERE +nextAttempt <= ? ORDER BY created LIMIT 1", (now,)).fetchone()
+    if row is None:
+      return None, []
+
+    rows = self.db.execute("""SELECT id, time, line, attempts FROM outbox
+      WHERE device = ? AND nextAttempt <= ? ORDER BY created, time LIMIT ?""", (row[0], now, limit)).fetchall()
+    return row[0], rows
+
+  def GetRetryDelay(self, attempts:int):
+    delay = min(self.retryMaxDelay, self.retryBaseDelay * (2 ** min(attempts, 16)))
+    return delay * random.uniform(0.5, 1.5)
+
+  def Acknowledge(self, device:str, rows):
+    self.db.executemany("DELETE FROM outbox WHERE device = ? AND id = ? AND time = ?",
+      [(device, row[0], row[1]) for row in rows])
+    self.db.commit()
+
+  def Postpone(self, device:str, rows, now:float):
+    self.db.executemany("UPDATE outbox SET attempts = ?, nextAttempt = ? WHERE device = ? AND id = ? AND time = ?",
+      [(row[3] + 1, now + self.GetRetryDelay(row[3]), device, row[0], row[1]) for row in rows])
+    self.db.commit()
+
+  def GetWaitTime(self, now:float):
+    #seconds until something can be sent, None when the outbox is empty
+    nextAttempt = self.db.execute("SELECT MIN(nextAttempt) FROM outbox").fetchone()[0]
+    if nextAttempt is None:
+      return None
+    return max(nextAttempt, self.pausedUntil) - now
+
+  async def Run(self, uploader:UploadService):
+    while True:
+      wait = self.GetWaitTime(time.time())
+      if wait is None or wait > 0:
+        self.wakeEvent.clear()
+        try:
+          await asyncio.wait_for(self.wakeEvent.wait(), wait)
+          if uploader.batchSize > 1:
+            await asyncio.sleep(uploader.flushInterval)  #let the transfer fill a batch
+        except asyncio.TimeoutError:
+          pass
+        continue
+
+      await self.SendDue(uploader)
+
+  async def SendDue(self, uploader:UploadService):
+    device, rows = self.GetDue(time.time(), uploader.batchSize)
+    if len(rows) == 0:
+      return
 
-  def OnReceive(sender, data):
-    nonlocal received
-    nonlocal done
-    nonlocal lastReceived
-    nonlocal clientOnReceive
+    ackCount = await SendTempSessions(uploader, device, [ParseSession(row[2]) for row in rows])
+    self.Acknowledge(device, rows[:ackCount])
 
-    lastReceived = GetElapsedMillis()
+    if ackCount == len(rows):
+      self.failures = 0
+      self.pausedUntil = 0
+      return
 
-    str = bytearray(data).decode("utf-8") 
-    received += str
+    now = time.time()
+    self.Postpone(device, rows[ackCount:], now)
+    metrics.Add("pepperoni_upload_retries_total", len(rows) - ackCount, device=device)
+    self.pausedUntil = now + self.GetRetryDelay(self.failures)
+    self.failures += 1
 
-    done = clientOnReceive(data)
+    depth, oldestAge = self.GetStats()
+    AddLog("WARNING:upload failed, outbox depth {0} oldest {1:.0f}s, retrying in {2:.0f}s".format(depth, oldestAge, self.pausedUntil - now))
 
-    AddDebugLog("Received @{1} ble data:'{0}'".format(str, lastReceived))
+def AddToOutbox(instance, record:SessionRecord):
+  #returns True when the session is new
+  if instance.gateway.sessionIndex.Add(instance.name, record.id, record.time) == False:
+    return False
 
-  await client.start_notify(char, OnReceive)
+  line = record.ToLine()
+  with open(instance.readingsFilepath, "a") as readings:
+    readings.write(line + "\n")
+  instance.store.Append(record)
+  instance.gateway.outbox.Add(instance.name, record.id, record.time, line)
+  return True
 
-  await SendCommand(instance, client, char, cmd)
+async def UploadReadings(instance):
+  #moves sessions from the upload queue to the outbox as the transfer
+  #streams them, the outbox sends them once they are on disk
 
-  while done == False:
-    elapsed = GetElapsedMillis() - lastReceived
-    if elapsed >= timeout:
-      break
-    await asyncio.sleep(0.01)
+  outbox = instance.gateway.outbox
+  sessionIndex = instance.gateway.sessionIndex
 
-  AddLog("End command {0}".format(GetElapsedMillis()))
+  sessionIndex.ImportReadings(instance.name, instance.readingsFilepath)
 
-  await client.stop_notify(char)
+  queuedCount = 0
+  while True:
+    record = await instance.uploadQueue.get()
+
+    #None marks the end of a transfer
+    if record is not None and AddToOutbox(instance, record):
+      queuedCount += 1
+
+    if instance.uploadQueue.empty():
+      #index and outbox rows are committed together
+      sessionIndex.Commit()
+
+      instance.store.Flush()
+      if instance.store.NeedsCompaction():
+        instance.store.Compact()
+
+      if queuedCount:
+        depth, oldestAge = outbox.GetStats()
+        AddLog("Queued {0} temperature sessions, outbox depth {1} oldest {2:.0f}s".format(queuedCount, depth, oldestAge))
+        queuedCount = 0
+        outbox.Wake()
+
+      if instance.transferActive == False:
+        #everything journaled so far is in the outbox
+        if os.path.exists(instance.newReadingsFilepath):
+          os.remove(instance.newReadingsFilepath)
+          instance.SaveState()
+
+class ClockModel:
+  #module clock against the gateway clock, to only send "unixtime" when
+  #the module is predicted off by syncThreshold seconds or more.
+  #a module advertises the start time of the session it just wrote and
+  #starts the next one at its current time, so an advert changing to
+  #time A tells the module clock read A when the previous change was
+  #seen. a sync sets the offset to 0, the drift is the slope of the
+  #offsets against the time since the sync they follow
+  syncThreshold = 0.5
+  maxSyncAge = 7 * 24 * 60 * 60
+  #gap between the last advert of the old time and the first of the new
+  #one, the change is taken at its middle. a change seen later is too
+  #uncertain to be a sample
+  maxChangeWindow = 2
+  maxSamples = 64
+  minSamples = 8
+  #assumed until samples give the drift, 32 kHz crystal tolerance
+  defaultDrift = 50e-6
+  defaultRtt = 0.1
+  #an offset this large means the module lost its time
+  maxOffset = 60
+
+  def __init__(self, device:str):
+    self.device = device
+    self.syncTime = 0          #gateway time of the last sync, 0 when the module time is unknown
+    self.previousSyncTime = 0
+    self.drift = None          #module seconds gained per second
+    self.driftError = 0        #standard error of the drift
+    self.rtt = None            #write to first response, seconds
+    self.samples = []          #(seconds since sync, module - gateway offset)
+    self.advertTime = None
+    self.advertSeen = 0
+    self.changeTime = None
+
+  def GetState(self):
+    return {"syncTime" : self.syncTime, "drift" : self.drift, "driftError" : self.driftError, "rtt" : self.rtt, "samples" : self.samples}
+
+  def SetState(self, state):
+    self.syncTime = state.get("syncTime", 0)
+    self.drift = state.get("drift")
+    self.driftError = state.get("driftError", 0)
+    self.rtt = state.get("rtt")
+    self.samples = [tuple(sample) for sample in state.get("samples", [])]
+
+  def OnAdvert(self, sessionTime:int, now:float):
+    if sessionTime == self.advertTime:
+      self.advertSeen = now
+      return
 
-  return received
+    if sessionTime == 0 and self.advertTime:
+      #rebooted, the module time restarted
+      self.syncTime = 0
+      self.previousSyncTime = 0
+
+    if self.advertTime and sessionTime > self.advertTime and self.changeTime is not None:
+      self.AddSample(self.changeTime, sessionTime - self.changeTime)
+
+    window = now - self.advertSeen
+    self.changeTime = None
+    if self.advertTime is not None and window <= self.maxChangeWindow:
+      self.changeTime = now - window / 2
+    self.advertTime = sessionTime
+    self.advertSeen = now
+
+  def AddSample(self, changeTime:float, offset:float):
+    #the sample belongs to the sync in effect when the change was seen
+    syncTime = self.syncTime
+    if changeTime < syncTime:
+      syncTime = self.previousSyncTime
+    if syncTime == 0 or changeTime < syncTime:
+      return
 
-def UploadReadings(instance):
-  
-  if os.path.exists(instance.newReadingsFilepath) == False:
-    return
+    metrics.Observe("pepperoni_clock_offset_seconds", abs(offset), device=self.device)
+    if abs(offset) >= self.maxOffset:
+      self.syncTime = 0
+      return
 
-  server = instance.server
-  deviceName = instance.device.name
-
-  uniqueSessions = set()
-
-  if os.path.exists(instance.readingsFilepath):
-    #create a set with unique readings
-    readings = open(instance.readingsFilepath, "r")  
-    for session in readings:
-      uniqueSessions.add(session)
-    readings.close()
-
-  readings = open(instance.readingsFilepath, "a")
-  newReadings = open(instance.newReadingsFilepath, "r")
-  uploadCount = 0
-  for session in newReadings:
-    if session not in uniqueSessions:
-      uniqueSessions.add(session)
-      readings.write(session)
-      session = session.replace("\n", "");
-      SendTempSession(server, deviceName, session)
-      uploadCount += 1
-
-  readings.close()
-  newReadings.close()
-  AddLog("Uploaded {0} temperature sessions".format(uploadCount))
-
-  os.remove(instance.newReadingsFilepath)
-
-async def SendUnixtime(instance, client):
-  svcs = await client.get_services()
-
-  writeSrv = None
-
-  for service in svcs:
-      #AddLog("service {0}".format(service.uuid))
-      #if service.uuid == "000000ff-0000-1000-8000-00805f9b34fb":
-      #    writeSrv = service;
-      if service.uuid == "000000ee-0000-1000-8000-00805f9b34fb":
-          writeSrv = service;
-
-  for char in writeSrv.characteristics:
-    if char.uuid == "0000ee01-0000-1000-8000-00805f9b34fb":
-      writeChar = char
-
-  def OnReceiveCommand(data):
-      AddLog(data)
-      return True
-      
-  AddLog("Sending unixtime")
-  timeout = 100
-  await SendCommandAndReceive(instance, client, writeChar, "unixtime {0}".format(GetUnixtime()), timeout, OnReceiveCommand)
+    self.samples.append((changeTime - syncTime, offset))
+    del self.samples[:-self.maxSamples]
+    if len(self.samples) >= self.minSamples:
+      sumSquares = max(sum(x * x for x, y in self.samples), 1)
+      self.drift = sum(x * y for x, y in self.samples) / sumSquares
+      residual = sum((y - self.drift * x) ** 2 for x, y in self.samples) / (len(self.samples) - 1)
+      self.driftError = math.sqrt(residual / sumSquares)
+
+  def PredictError(self, now:float):
+    #seconds the module is predicted off, None when its time is unknown
+    if self.syncTime == 0:
+      return None
+    #two standard errors of margin, few samples give a loose estimate
+    drift = abs(self.drift) + 2 * self.driftError if self.drift is not None else self.defaultDrift
+    return drift * (now - self.syncTime)
+
+  def NeedsSync(self, now:float, horizon:float = 0):
+    #horizon is the time to the next connection, the error must stay
+    #under the threshold until then
+    error = self.PredictError(now + horizon)
+    return error is None or error >= self.syncThreshold or now - self.syncTime >= self.maxSyncAge
+
+  def OnSync(self, now:float):
+    self.previousSyncTime = self.syncTime
+    self.syncTime = now
+
+  def OnRtt(self, rtt:float):
+    self.rtt = rtt if self.rtt is None else 0.8 * self.rtt + 0.2 * rtt
+
+  def GetRtt(self):
+    return self.rtt if self.rtt is not None else self.defaultRtt
+
+async def SendUnixtime(instance, session):
+  clock = instance.clock
+  now = time.time()
+  #a connection follows each session the module writes
+  if clock.NeedsSync(now, instance.period * maxValues) == False:
+    drift = clock.drift if clock.drift is not None else clock.defaultDrift
+    AddLog("Clock predicted within {0:.2f}s (drift {1:.1f} ppm), not sending unixtime".format(
+      clock.PredictError(now), drift * 1e6))
+    metrics.Add("pepperoni_clock_syncs_skipped_total", device=instance.name)
+    return
 
-async def GetWriteChar(client):
-  svcs = await client.get_services()
+  async def MakeCommand():
+    #the module keeps whole seconds and sets its time about rtt/2 after
+    #the write, send so that the next whole second lands on the module
+    oneWay = clock.GetRtt() / 2
+    now = time.time()
+    target = math.floor(now + oneWay) + 1
+    await asyncio.sleep(max(target - oneWay - now, 0))
+    return "unixtime {0}".format(target)
 
-  writeSrv = None
+  AddLog("Sending unixtime, rtt {0:.0f} ms".format(clock.GetRtt() * 1000))
+  #completes on the first response
+  received = await session.Run(MakeCommand, None, 1000)
+  clock.OnSync(time.time())
+  metrics.Add("pepperoni_clock_syncs_total", device=instance.name)
+  AddLog(received)
 
-  for service in svcs:
-      #AddLog("service {0}".format(service.uuid))
-      #if service.uuid == "000000ff-0000-1000-8000-00805f9b34fb":
-      #    writeSrv = service;
-      if service.uuid == "000000ee-0000-1000-8000-00805f9b34fb":
-          writeSrv = service;
 
-  for char in writeSrv.characteristics:
-    if char.uuid == "0000ee01-0000-1000-8000-00805f9b34fb":
-      writeChar = char
+async def PostBatt(instance, batt:int):
+  urlParams = {
+    'mod' : instance.name,
+    'batt' : str(batt) }
 
-  return writeChar
+  instance.lastBattRead = GetUnixtime()
 
+  #queued only, the upload completes after the connection
+  await instance.gateway.uploader.Post("/pepperoni/", urlParams)
+  AddLog("Batt data queued")
 
-async def ReadBatt(instance, client):
+async def ReadBatt(instance, session):
 
+  #modules advertising their battery have it posted from the advert,
+  #only connected reads of older modules get here once a day
   elapsedSinceLastBattRead = GetUnixtime() - instance.lastBattRead
   secondsIn24Hour = 24 * 60 * 60
-  forceReadBatt = True
-  if elapsedSinceLastBattRead >= secondsIn24Hour or instance.testbatt or forceReadBatt:
+  if elapsedSinceLastBattRead >= secondsIn24Hour or instance.testbatt:
     
-    battData = ""
-
-    def OnReceive(data):
-      nonlocal battData
-      data = str(data) 
-
-      battData += data
-      return False
+    battData = await session.Run("batt", "Batt:", 1000)
 
-    writeChar = await GetWriteChar(client)
-
-    await SendCommandAndReceive(instance, client, writeChar, "batt", 300, OnReceive)
-
-    instance.lastBattRead = GetUnixtime()
     AddLog("Batt data:" + battData)
 
     words = battData.split(":")
@@ -287,114 +899,176 @@ async def ReadBatt(instance, client):
           words[1] = words[1][0:i]
           break
 
-
-      deviceName = instance.device.name
-
-      url = instance.server + "/pepperoni/"
-
       try:
-          words[1] = str(int(words[1]))
+          await PostBatt(instance, int(words[1]))
       except ValueError:
           print('Cannot convert batt level to integer')
-
-      urlParams = {
-        'mod' : deviceName,
-        'batt' : words[1] }
-
-      SendServerRequest(instance.server, "/pepperoni/", urlParams)
-      AddLog("Batt data sent")
     else:
       AddLog("WARNING:batt data invalid")
 
-async def SendTestCommand(instance, client):
+async def SendTestCommand(instance, session):
   if instance.sendTestCommand:
     AddDebugLog("SendTestCommand")
-    def OnReceiveCommand(data):
-      return True
-
-    writeChar = await GetWriteChar(client)
-
-    await SendCommandAndReceive(instance, client, writeChar, "version", 20, OnReceiveCommand)
-
-
-
-async def ReadDataSessions(instance, client):
-  
-  writeChar = await GetWriteChar(client)
-
-  lastReceived = GetUnixtime()
+    await session.Run("version", "GJ hash", 1000)
 
-  fullLine = ""
-  done = False
-  readingsCount = 0
-  sessions = []
 
-  def OnReceive(sender, data):
-    nonlocal fullLine
-    nonlocal done
-    nonlocal readingsCount
-    nonlocal sessions
-    nonlocal lastReceived
 
-    lastReceived = GetUnixtime()
+async def StreamCommandLines(session, cmd:str, terminator, timeout, firstTimeout = None):
+  #yields the response lines of a command as they are received
+  lines = asyncio.Queue()
+  future = session.Command(cmd, terminator, timeout, lines.put_nowait, firstTimeout)
 
-    str = bytearray(data).decode("utf-8") 
-    fullLine += str
+  while lines.empty() == False or future.done() == False:
+    getter = asyncio.ensure_future(lines.get())
+    await asyncio.wait([getter, future], return_when=asyncio.FIRST_COMPLETED)
+    if getter.done():
+      yield getter.result()
+    else:
+      getter.cancel()
 
-    pos = fullLine.find("\n")
-    if pos == -1:
-      return
+  future.result()
 
-    fullLine = fullLine.replace("\n", "")
-    AddLog(fullLine)
+#"turndata disp" resumes within the same connection
+maxDispResumes = 2
 
-    if fullLine.find("Data readings") != -1:
-      readingsCount = 0
-    elif fullLine.find("Total readings:") != -1:
-      readingsCount = int(fullLine[15:])
-      done = True
-    elif fullLine.find("id:") != -1 and fullLine.find("t:") != -1 and fullLine.find("p:") != -1:
-      sessions.append(fullLine)
+#ms to wait for the first line of "turndata bindisp", a module that doesn't
+#know it may not answer at all. an unknown command reply ends it right away
+binaryProbeTimeout = 1500
+unknownCommandReply = "nknown"
 
-    fullLine = ""
+#advertised flash fill percent that triggers a clear after a complete transfer
+clearFlashFill = 75
 
-  await client.start_notify(writeChar, OnReceive)
+async def ReadDataSessions(instance, session):
+  
+  readingsCount = None
+  sessionCount = 0
+  resumeIndex = 0
+  complete = False
+  minTime = GetUnixtime()
+  maxTime = 0
 
   #newestSessionTime is used to transfer new readings only
   #otherwise all readings are sent on each query until a clear is executed
-  dispCommand = "turndata disp " + str(instance.newestSessionTime + 1)
-  await SendCommand(instance, client, writeChar, dispCommand)
-  AddLog("disp command:" + dispCommand)
-  while done == False:
-    elapsed = GetUnixtime() - lastReceived
-    if elapsed >= 5:
-      break
-    await asyncio.sleep(1)
-
-  await client.stop_notify(writeChar)
+  dispTime = instance.newestSessionTime + 1
 
-  if readingsCount != len(sessions):
-    raise ValueError('Not all Readings were transfered')
+  transferBegin = time.perf_counter()
+  bytesBegin = session.bytesReceived
 
-  localFile = open(instance.newReadingsFilepath, "a")
-
-  minTime = GetUnixtime()
-  maxTime = 0
-  for session in sessions:
-    fileSession = session + "\n"
-    localFile.write(fileSession)
-    sessionTime = GetSessionTime(session)
-    instance.period = GetSessionPeriod(session)
-    #tempCount = GetSessionValueCount(session)
-    minTime = min(minTime, sessionTime)
-    maxTime = max(maxTime, sessionTime)
-
-  localFile.close()
+  #each session is journaled and queued for upload as soon as it arrives
+  instance.transferActive = True
+  instance.transferComplete = False
+  journal = SessionJournal(instance.newReadingsFilepath)
+  try:
+    for attempt in range(maxDispResumes + 1):
+      if attempt:
+        metrics.Add("pepperoni_transfer_resumes_total", device=instance.name)
+
+      #a dump cut off mid-way resumes at the first session not received.
+      #the index counts sessions >= dispTime, firmware without
+      #cursor support ignores it and restarts, the index dedups the repeats
+      dispCommand = ("turndata bindisp " if instance.binaryDisp else "turndata disp ") + str(dispTime)
+      if resumeIndex:
+        dispCommand += " " + str(resumeIndex)
+      AddLog("disp command:" + dispCommand)
+
+      readingsCount = None
+      passCount = 0
+      headerReceived = False
+      passResumeIndex = resumeIndex
+      passNewestSessionTime = instance.newestSessionTime
+      #sessions after a garbled line are kept but the resume index and
+      #newestSessionTime stop at it, so it is asked for again
+      gap = False
+
+      #wait up to 5 seconds of silence between sessions
+      if instance.binaryDisp:
+        lines = StreamCommandLines(session, dispCommand, ("Total readings:", unknownCommandReply), 5000, binaryProbeTimeout)
+      else:
+        lines = StreamCommandLines(session, dispCommand, "Total readings:", 5000)
+      async for line in lines:
+        #the raw notifications are in the gateway trace
+        AddDebugLog(line)
+
+        if line.find("Data sessions:") != -1:
+          headerReceived = True
+          if IsSessionFragment(line[line.find("Data sessions:") + len("Data sessions:"):], instance.binaryDisp):
+            #the first session merged into the header
+            AddLog("WARNING:session fragment '{0}'".format(line))
+            gap = True
+        elif line.find("Total readings:") != -1:
+          readingsCount = int(line[15:])
+        elif line.startswith("id:") or line.startswith(framePrefix):
+          try:
+            record = ParseSession(line) if line.startswith("id:") else DecodeSessionFrame(line)
+            if len(record.values) != maxValues:
+              raise ValueError("{0} values".format(len(record.values)))
+          except ValueError as e:
+            AddLog("WARNING:invalid session '{0}' ({1})".format(line, e))
+            gap = True
+            continue
+
+          #the journal and readings keep the text form
+          journal.Append(record.ToLine())
+          instance.uploadQueue.put_nowait(record)
+
+          instance.period = record.period
+          minTime = min(minTime, record.time)
+          maxTime = max(maxTime, record.time)
+          passCount += 1
+
+          if gap == False:
+            #a transfer cut off later resumes after this session
+            resumeIndex += 1
+            instance.newestSessionTime = max(record.time, instance.newestSessionTime)
+        elif IsSessionFragment(line, instance.binaryDisp):
+          #the start of a session lost with a notification, other firmware output is ignored
+          AddLog("WARNING:session fragment '{0}'".format(line))
+          gap = True
+
+      sessionCount += passCount
+
+      if readingsCount == passCount and gap == False:
+        complete = True
+        break
+
+      if readingsCount is not None and passCount < readingsCount and gap == False:
+        #a whole session was lost without a trace, where is unknown.
+        #the pass is asked for again, the index drops the repeats
+        AddLog("WARNING:{0} of {1} sessions received".format(passCount, readingsCount))
+        resumeIndex = passResumeIndex
+        instance.newestSessionTime = passNewestSessionTime
+
+      if instance.binaryDisp and headerReceived == False and readingsCount is None and passCount == 0:
+        AddLog("binary transfer not supported, using text")
+        instance.binaryDisp = False
+        continue
+
+      AddLog("WARNING:transfer cut off after {0} sessions".format(sessionCount))
+  finally:
+    journal.Close()
+    instance.transferActive = False
+    instance.uploadQueue.put_nowait(None)
+
+  transferTime = time.perf_counter() - transferBegin
+  transferBytes = session.bytesReceived - bytesBegin
+  metrics.Observe("pepperoni_transfer_seconds", transferTime, device=instance.name)
+  metrics.Add("pepperoni_transfer_sessions_total", sessionCount, device=instance.name)
+  metrics.Add("pepperoni_transfer_bytes_total", transferBytes, device=instance.name)
+  if sessionCount and transferTime > 0:
+    metrics.Observe("pepperoni_transfer_sessions_per_second", sessionCount / transferTime, device=instance.name)
+    metrics.Observe("pepperoni_transfer_bytes_per_second", transferBytes / transferTime, device=instance.name)
 
   if instance.oldestSessionTime == 0:
     instance.oldestSessionTime = minTime
 
-  AddLog("transfered {0} data sessions".format(len(sessions)))
+  AddLog("transfered {0} data sessions".format(sessionCount))
+
+  instance.transferComplete = complete
+  if complete == False:
+    #keep what was received, the rest is read on the next connection
+    AddLog("WARNING:transfer incomplete, {0} sessions received".format(sessionCount))
+    return
 
   elapsedSinceOldest = GetUnixtime() - instance.oldestSessionTime
   secondsIn3Days = 3 * 24 * 60 * 60
@@ -402,43 +1076,74 @@ async def ReadDataSessions(instance, client):
   #clear readings once in a while.
   #but not too often to avoid flash wear
   #this can duplicate readings in the webserver data file
-  #and must be handled accordingly
-  if (elapsedSinceOldest >= secondsIn3Days and instance.oldestSessionTime != 0) and instance.enableClear:
-    def OnReceive(data):
-      return True #exit stop receiving upon first message
-    await SendCommandAndReceive(instance, client, writeChar, "turndata clear", 50, OnReceive)
+  #and must be handled accordingly.
+  #a module advertising a nearly full file is cleared early, it erases
+  #everything on its own once full
+  nearlyFull = instance.flashFill is not None and instance.flashFill >= clearFlashFill
+  if ((elapsedSinceOldest >= secondsIn3Days and instance.oldestSessionTime != 0) or nearlyFull) and instance.enableClear:
+    await session.Run("turndata clear", "cleared", 1000)
     #await asyncio.sleep(5.0)
     instance.oldestSessionTime = 0
     AddLog("Data sessions cleared")
-    
-  #add 1 to skip the last recorded timestamp
-  instance.newestSessionTime = max(maxTime, instance.newestSessionTime)
+
+class AdvertData:
+  #decoded manufacturer data.
+  #version 1 modules only advertise sessionTime, the other fields stay None
+  payloadStruct = struct.Struct("<IBBHHHH")
+
+  def __init__(self):
+    self.version = 0
+    self.sessionTime = 0
+    self.flashFill = None
+    self.batt = None
+    self.sessionCount = None
+    self.lastError = None
+    self.tagHash = None
 
 def ReadAdvertData(instance):
   AddDebugLog("Reading advert data...")
 
-  #AddLog(dir(instance.device))
-  #AddLog(dir(instance.device.metadata))
-  instance.device.metadata.update()
+  #manufacturer data is pushed by the ScannerService on every advert
+  b = instance.manufData
 
-  b = instance.device.metadata['manufacturer_data']
+  advert = AdvertData()
 
-  if len(b):
-    b = b[65535]
+  if b is not None:
+    AddDebugLog("Advert len {0} data {1}".format(len(b), b))
 
-    unixtime = 0
+    #the payload follows its length + 1 and 0xff
+    if len(b) >= 6 and b[0] == len(b) - 1 and b[1] == 0xff:
+      advert.version = 1
+      advert.sessionTime = b[2] | (b[3] << 8) | (b[4] << 16) | (b[5] << 24) 
 
-    AddDebugLog("Advert len {0} data {1}".format(len(b), b))
+      if len(b) >= 2 + AdvertData.payloadStruct.size and b[6] >= 2:
+        (advert.sessionTime, advert.version, advert.flashFill, advert.batt,
+          advert.sessionCount, advert.lastError, advert.tagHash) = AdvertData.payloadStruct.unpack_from(b, 2)
 
-    if b[0] == 0x05 and b[1] == 0xff and len(b) == 6:
-      unixtime = b[2] | (b[3] << 8) | (b[4] << 16) | (b[5] << 24) 
+  return advert
 
-  return unixtime
+def HashTag(tag:str):
+  #same as the firmware's HashTag, FNV-1a folded to 16 bits
+  value = 2166136261
+  for c in tag.encode():
+    value = ((value ^ c) * 16777619) & 0xffffffff
+  return (value >> 16) ^ (value & 0xffff)
 
 async def ConnectAndTransfer(instance):
+  #the adapter only handles a few links at once, wait for a free slot
+  begin = time.perf_counter()
+  async with instance.gateway.connectionSemaphore:
+    metrics.Observe("pepperoni_link_wait_seconds", time.perf_counter() - begin, device=instance.name)
+    return await ConnectAndTransferLocked(instance)
+
+#a second attempt right away covers a stale characteristic handle,
+#later attempts are planned by the device's RetryPolicy
+connectAttempts = 2
+
+async def ConnectAndTransferLocked(instance):
   exceptionCount = 0
   while True:
-      if exceptionCount > 5:
+      if exceptionCount >= connectAttempts:
           break
       try:
           
@@ -453,106 +1158,449 @@ async def ConnectAndTransfer(instance):
 
           #if elapsed >= _4Hours and readElapsed >= _1Hours:
           AddLog("Connecting to device...")
+          connectBegin = time.perf_counter()
+          instance.gateway.trace.Add(traceConnect, instance.name)
           
           async with BleakClient(instance.device) as client:
             await client.is_connected()
             AddLog("Connected")
+            connectedTime = time.perf_counter()
+            metrics.Observe("pepperoni_connect_seconds", connectedTime - connectBegin, device=instance.name)
+
+            session = ConnectionSession(instance, client)
+            await session.Open()
+            metrics.Observe("pepperoni_discovery_seconds", time.perf_counter() - connectedTime, device=instance.name)
+
+            try:
+              #commands are queued on the session and run back to back.
+              #the clock sync waits for a second boundary, it goes last
+              results = await asyncio.gather(
+                ReadDataSessions(instance, session),
+                ReadBatt(instance, session),
+                SendUnixtime(instance, session),
+                SendTestCommand(instance, session),
+                return_exceptions=True)
+            finally:
+              await session.Close()
+
+            for result in results:
+              if isinstance(result, Exception):
+                raise result
 
-            await SendUnixtime(instance, client)
-            await ReadDataSessions(instance, client)
-            await ReadBatt(instance, client)
-            await SendTestCommand(instance, client)
             await client.disconnect()
             client = None
             #instance.lastSessionRead = time.time()
             #del(client)
             
-          break
+          metrics.Observe("pepperoni_connection_seconds", time.perf_counter() - connectBegin, device=instance.name)
+          instance.gateway.trace.Add(traceDisconnect, instance.name)
+          return True
 
       except Exception as e:
           logger = logging.getLogger(__name__)
           tb = traceback.format_exc()
           logger.warning("exception in ConnectAndTransfer for {2} : {0} {1}".format(e, tb, instance.id))
+          metrics.Add("pepperoni_connect_errors_total", device=instance.name)
+          instance.gateway.trace.Add(traceError, instance.name, "{0}: {1}".format(type(e).__name__, e).encode())
+          DumpTrace(instance)
           exceptionCount += 1
+          #a stale handle (ie: after a firmware update) is looked up again
+          instance.gateway.charHandleCache.pop(instance.address, None)
           #exit()
 
+  return False
+
+def DumpTrace(instance):
+  #the BLE traffic that led to a failed connection, see bletrace.py
+  directory = instance.gateway.traceDirectory
+  if directory is None:
+    return
+
+  try:
+    os.makedirs(directory, exist_ok=True)
+    filepath = os.path.join(directory, "{0}_{1}.trace".format(instance.name, datetime.now().strftime('%Y%m%d_%H%M%S_%f')))
+    count = instance.gateway.trace.Dump(filepath, instance.name)
+    PruneTraces(directory, instance.gateway.maxTraceFiles)
+    AddLog("Trace of {0} events written to {1}".format(count, filepath))
+  except OSError as e:
+    AddLog("WARNING:trace not written: {0}".format(e))
+
+moduleNamePrefix = "peppe"
+moduleManufId = 65535
+
+class ScannerService:
+  #one scanner runs for the whole gateway lifetime and dispatches
+  #each module advert to the instance that owns it
+  seenMaxAge = 120      #seconds an address is listed after its last advert, phones rotate theirs
+
+  def __init__(self, gateway):
+    self.gateway = gateway
+    self.scanner = None
+    self.seenDevices = {}   #address -> (name, time.monotonic() of its last advert)
+    self.lastPrune = time.monotonic()
+
+  async def Start(self):
+    self.scanner = BleakScanner(detection_callback=self.OnDetection)
+    await self.scanner.start()
+    AddLog("Scanner started")
+
+  async def Stop(self):
+    if self.scanner is not None:
+      await self.scanner.stop()
+      self.scanner = None
+
+  def OnDetection(self, device:BLEDevice, advertisementData:AdvertisementData):
+    name = advertisementData.local_name or device.name
+    now = time.monotonic()
+    self.seenDevices[device.address] = (name, now)
+    if now - self.lastPrune > self.seenMaxAge:
+      self.PruneSeenDevices(now)
+
+    if name is None or name.startswith(moduleNamePrefix) == False:
+      return
+
+    manufData = advertisementData.manufacturer_data.get(moduleManufId)
+    if manufData is None:
+      return
+
+    instance = self.gateway.GetInstance(name)
+    if instance is not None:
+      instance.OnAdvert(device, bytes(manufData), advertisementData.rssi)
+
+  def PruneSeenDevices(self, now:float):
+    self.seenDevices = {address : seen for address, seen in self.seenDevices.items() if now - seen[1] <= self.seenMaxAge}
+    self.lastPrune = now
+
 async def FindDevice(instance, name:str):
-  scanner = BleakScanner()
-  await scanner.start()
-  target = None
+  #the shared scanner fills instance.device, only wait for the first advert
+  if instance.device is not None:
+    return
 
-  foundDeviceAddresses = set()
-  foundDevices = set()
-  beginTime = time.time()
   timeout = 60
-  while target is None:
-      devices = await scanner.get_discovered_devices()
-      for device in devices:
-          if device.address not in foundDeviceAddresses:
-              #AddLog(device)
-              foundDeviceAddresses.add(device.address)
-              foundDevices.add(device)
-          #AddLog(device)
-          if device.name == name:
-              target = device
-              instance.address = target.address
-              AddLog("found '{0}' {1}".format(name, target.address))
-              break
-      if (time.time() - beginTime) > timeout:
-          break;
-      await asyncio.sleep(0.5)
-
-  await scanner.stop()
-
-  if target is None:
+  begin = time.perf_counter()
+  try:
+    await asyncio.wait_for(instance.advertEvent.wait(), timeout)
+  except asyncio.TimeoutError:
+    pass
+
+  if instance.device is None:
+    metrics.Add("pepperoni_scan_failures_total", device=name)
     AddLog("Searching failed")
     AddLog("Scanned devices:")
-    for device in foundDevices:
-      AddLog(device)
+    for address, (deviceName, seenTime) in list(instance.gateway.scanner.seenDevices.items()):
+      AddLog("{0}: {1}".format(address, deviceName))
   else:
-    #AddLog("Searching done")
-    instance.device = target
-    instance.id = id
+    metrics.Observe("pepperoni_scan_seconds", time.perf_counter() - begin, device=name)
+    AddLog("found '{0}' {1}".format(name, instance.address))
+
+class ScheduleEntry:
+  __slots__ = ("wakeTime", "priority", "sequence", "instance", "cancelled")
+
+  def __init__(self, wakeTime:float, priority:int, sequence:int, instance):
+    self.wakeTime = wakeTime
+    self.priority = priority
+    self.sequence = sequence
+    self.instance = instance
+    self.cancelled = False
+
+class ConnectionScheduler:
+  #plans the wake-up of every device on one timeline.
+  #polls are spread so no more than maxConnections fall in the same slot,
+  #devices advertising new sessions are planned right away and released
+  #first. due devices are released while the adapter has a free link
+  slotDuration = 30
+  priorityPending = 0
+  priorityPoll = 1
+
+  def __init__(self, maxConnections:int):
+    self.maxConnections = maxConnections
+    self.queue = []     #(wakeTime, sequence, entry)
+    self.ready = []     #(priority, wakeTime, sequence, entry)
+    self.plans = {}     #device name -> planned entry
+    self.active = set()
+    self.turnEvents = {}
+    self.sequence = 0
+    self.changedEvent = asyncio.Event()
+
+  def PredictNextSession(self, instance):
+    #a module writes a session every period * 16 seconds, the one after
+    #the advertised session completes two session lengths after its start
+    if instance.period == 0 or instance.newestSessionTime == 0:
+      return None
+    return instance.newestSessionTime + instance.period * 16 * 2
+
+  def Plan(self, instance, wakeTime:float, priority:int = priorityPoll):
+    previous = self.plans.get(instance.name)
+    if previous is not None:
+      previous.cancelled = True
+
+    if priority != self.priorityPending:
+      wakeTime = self.Spread(instance, wakeTime)
+
+    self.sequence += 1
+    entry = ScheduleEntry(wakeTime, priority, self.sequence, instance)
+    self.plans[instance.name] = entry
+    heapq.heappush(self.queue, (wakeTime, entry.sequence, entry))
+    self.changedEvent.set()
+    return wakeTime
+
+  def Spread(self, instance, wakeTime:float):
+    #moves wakeTime forward until its slot has a free link
+    others = [entry.wakeTime for name, entry in self.plans.items() if name != instance.name]
+    step = self.slotDuration / self.maxConnections
+    while sum(1 for other in others if abs(other - wakeTime) < self.slotDuration) >= self.maxConnections:
+      wakeTime += step
+    return wakeTime
+
+  def OnAdvert(self, instance):
+    #a module advertising a session not read yet is planned now
+    if instance.name in self.active:
+      return
 
-async def ReadDevice(instance, name:str):
-  errors = 0
-  while True:
-      if errors > 5:
-          errors = 0
-          AddLog("Error count >= 5, pausing for 30 seconds")
-          await asyncio.sleep(30)
-          instance.device = None  #force rescan
-      try:
-          if instance.device is None:
-            await FindDevice(instance, name)
+    advert = ReadAdvertData(instance)
+    if advert.sessionTime <= instance.newestSessionTime or advert.sessionTime == instance.promotedSessionTime:
+      return
 
-          if instance.device is not None:
-            advertSessionTime = ReadAdvertData(instance)
-            AddLog("Advertized session time {0} Last Read Session time {1}".format(advertSessionTime, instance.newestSessionTime))
+    #backing off or parked devices keep their plan
+    if instance.retryPolicy.CanAttempt(time.time()) == False:
+      return
 
-            secondsIn24Hour = 24 * 60 * 60
+    instance.promotedSessionTime = advert.sessionTime
+    AddDebugLog("Advert of '{0}' shows new data".format(instance.name))
+    self.Plan(instance, time.time(), self.priorityPending)
+
+  async def WaitTurn(self, instance):
+    if instance.name not in self.plans:
+      self.Plan(instance, time.time())
+
+    event = self.turnEvents.setdefault(instance.name, asyncio.Event())
+    await event.wait()
+    event.clear()
+
+  def Done(self, instance):
+    self.active.discard(instance.name)
+    self.changedEvent.set()
+
+  def Release(self, now:float):
+    while self.queue and self.queue[0][0] <= now:
+      wakeTime, sequence, entry = heapq.heappop(self.queue)
+      if entry.cancelled == False:
+        heapq.heappush(self.ready, (entry.priority, wakeTime, sequence, entry))
+
+    while self.ready and len(self.active) < self.maxConnections:
+      entry = heapq.heappop(self.ready)[3]
+      if entry.cancelled:
+        continue
+
+      name = entry.instance.name
+      del self.plans[name]
+      self.active.add(name)
+      self.turnEvents.setdefault(name, asyncio.Event()).set()
+
+  def GetTimeline(self):
+    #planned wake-ups, soonest first: (wakeTime, device name, priority)
+    entries = sorted(self.plans.values(), key=lambda entry: (entry.wakeTime, entry.priority))
+    return [(entry.wakeTime, entry.instance.name, entry.priority) for entry in entries]
+
+  def LogTimeline(self):
+    AddLog("Schedule, active:{0}".format(",".join(sorted(self.active)) or "none"))
+    for wakeTime, name, priority in self.GetTimeline():
+      AddLog("  {0} {1}{2}".format(datetime.fromtimestamp(wakeTime).strftime('%Y-%m-%d %H:%M:%S'), name,
+        " (pending data)" if priority == self.priorityPending else ""))
+
+  async def Run(self, timelineInterval:float):
+    nextTimelineLog = time.time() + timelineInterval
+    while True:
+      now = time.time()
+      self.changedEvent.clear()
+      self.Release(now)
+
+      if timelineInterval > 0 and now >= nextTimelineLog:
+        self.LogTimeline()
+        nextTimelineLog = now + timelineInterval
+
+      timeout = None
+      if self.queue:
+        timeout = max(self.queue[0][0] - now, 0)
+      if timelineInterval > 0:
+        timeout = min(timeout if timeout is not None else timelineInterval, max(nextTimelineLog - now, 0))
 
-            needReadFromAdvert = advertSessionTime != 0 and advertSessionTime != instance.newestSessionTime
-            needReadBatt = (GetUnixtime() - instance.lastBattRead) > secondsIn24Hour
-            needReadFromDebug = instance.debug
-            if needReadFromAdvert or needReadBatt or needReadFromDebug:
-              await ConnectAndTransfer(instance)
+      try:
+        await asyncio.wait_for(self.changedEvent.wait(), timeout)
+      except asyncio.TimeoutError:
+        pass
+
+class RetryPolicy:
+  #connection retries of one device: exponential backoff with jitter after
+  #each failure, and a circuit breaker parking the device once failures
+  #pile up so an out of range or flat module doesn't hog the adapter.
+  #a parked device gets one trial connection when the breaker expires,
+  #failing it parks the device twice as long
+  baseDelay = 15
+  maxDelay = 10 * 60
+  breakerThreshold = 5
+  breakerTimeout = 30 * 60
+  breakerMaxTimeout = 6 * 60 * 60
+
+  def __init__(self):
+    self.failures = 0
+    self.parkCount = 0
+    self.nextAttempt = 0
+    self.parkedUntil = 0
+
+  def CanAttempt(self, now:float):
+    return now >= self.nextAttempt
+
+  def IsParked(self, now:float):
+    return now < self.parkedUntil
+
+  def OnSuccess(self):
+    self.failures = 0
+    self.parkCount = 0
+    self.nextAttempt = 0
+    self.parkedUntil = 0
+
+  def OnFailure(self, now:float):
+    #returns the time of the next attempt
+    self.failures += 1
+
+    if self.failures >= self.breakerThreshold:
+      timeout = min(self.breakerMaxTimeout, self.breakerTimeout * (2 ** min(self.parkCount, 16)))
+      self.parkCount += 1
+      #half open, the trial connection parks again when it fails
+      self.failures = self.breakerThreshold - 1
+      self.parkedUntil = now + timeout
+      self.nextAttempt = self.parkedUntil
+    else:
+      delay = min(self.maxDelay, self.baseDelay * (2 ** (self.failures - 1)))
+      self.nextAttempt = now + delay * random.uniform(0.5, 1.5)
+
+    return self.nextAttempt
+
+#seconds before a device gated by a weak signal is looked at again
+rssiRecheckDelay = 2 * 60
+
+def CheckConnection(instance, now:float):
+  #returns when to look at the device again if it shouldn't be connected now
+  retryPolicy = instance.retryPolicy
+  if retryPolicy.CanAttempt(now) == False:
+    AddLog("'{0}' {1} until {2}".format(instance.name, "parked" if retryPolicy.IsParked(now) else "backing off",
+      datetime.fromtimestamp(retryPolicy.nextAttempt).strftime('%Y-%m-%d %H:%M:%S')))
+    return retryPolicy.nextAttempt
+
+  minRssi = instance.gateway.minRssi
+  if minRssi is not None and instance.rssi is not None and instance.rssi < minRssi:
+    AddLog("'{0}' signal too weak ({1} dBm < {2} dBm), connection postponed".format(instance.name, instance.rssi, minRssi))
+    return now + rssiRecheckDelay
+
+  return None
+
+def OnConnectionFailed(instance, now:float):
+  retryPolicy = instance.retryPolicy
+  nextAttempt = retryPolicy.OnFailure(now)
+  nr = datetime.fromtimestamp(nextAttempt).strftime('%Y-%m-%d %H:%M:%S')
+  metrics.Add("pepperoni_connection_failures_total", device=instance.name)
+
+  if retryPolicy.IsParked(now):
+    metrics.Add("pepperoni_parked_total", device=instance.name)
+    AddLog("WARNING:'{0}' parked until {1}".format(instance.name, nr))
+    instance.ForgetDevice()  #wait for a fresh advert
+  else:
+    AddLog("'{0}' failure {1}, retrying at {2}".format(instance.name, retryPolicy.failures, nr))
 
-              UploadReadings(instance)
+  return nextAttempt
 
-              if instance.newestSessionTime == 0:
-                #module can return no data even when advert time is non 0
-                #this happens right after a data clear
-                instance.newestSessionTime = advertSessionTime
+async def ReadDevice(instance, name:str):
+  scheduler = instance.gateway.scheduler
+  while True:
+      try:
+          if instance.device is None:
+            await FindDevice(instance, name)
 
-            instance.device = None  #advert data not refreshed otherwise
+          await scheduler.WaitTurn(instance)
+          turnBegin = time.perf_counter()
+          nextAttempt = None
+          try:
+            if instance.device is not None:
+              advert = ReadAdvertData(instance)
+              advertSessionTime = advert.sessionTime
+              AddLog("Advertized session time {0} Last Read Session time {1}".format(advertSessionTime, instance.newestSessionTime))
+
+              secondsIn24Hour = 24 * 60 * 60
+
+              needReadFromAdvert = advertSessionTime != 0 and advertSessionTime != instance.newestSessionTime
+              needReadBatt = (GetUnixtime() - instance.lastBattRead) > secondsIn24Hour
+              needReadFromDebug = instance.debug
+
+              if advert.version >= 2:
+                AddLog("Advert v{0} sessions {1} flash {2}% batt {3} error {4} tag {5:04x}".format(
+                  advert.version, advert.sessionCount, advert.flashFill, advert.batt, advert.lastError, advert.tagHash))
+
+                if advert.lastError != instance.lastError and advert.lastError != 0:
+                  AddLog("WARNING:module '{0}' last error {1}".format(instance.name, advert.lastError))
+                if instance.tagHash is not None and advert.tagHash != instance.tagHash:
+                  AddLog("module '{0}' firmware changed".format(instance.name))
+
+                instance.lastError = advert.lastError
+                instance.tagHash = advert.tagHash
+                instance.flashFill = advert.flashFill
+
+                if advert.sessionCount == 0 and needReadFromAdvert:
+                  #cleared module, its next session starts after the advertised one
+                  AddLog("No stored session, skipping connection")
+                  instance.newestSessionTime = advertSessionTime
+                  needReadFromAdvert = False
+                  instance.SaveState()
+
+                if needReadBatt and advert.batt:
+                  await PostBatt(instance, advert.batt)
+                  needReadBatt = False
+                  instance.SaveState()
+
+              if needReadFromAdvert or needReadBatt or needReadFromDebug:
+                nextAttempt = CheckConnection(instance, time.time())
+
+              if (needReadFromAdvert or needReadBatt or needReadFromDebug) and nextAttempt is None:
+                newestBefore = instance.newestSessionTime
+                transfered = await ConnectAndTransfer(instance)
+
+                if instance.newestSessionTime == 0 and instance.transferComplete:
+                  #module can return no data even when advert time is non 0
+                  #this happens right after a data clear. after a gap in the
+                  #first sessions it stays 0 so they are asked for again
+                  instance.newestSessionTime = advertSessionTime
+
+                if transfered:
+                  #received sessions are fsynced in the journal at this point
+                  instance.SaveState()
+
+                #a dump cut off before any new session (ie: at the edge of range)
+                #backs off like a failed connection
+                progressed = instance.transferComplete or instance.newestSessionTime != newestBefore
+
+                if transfered and progressed:
+                  instance.retryPolicy.OnSuccess()
+                  if instance.transferComplete == False:
+                    #the missing sessions are asked for again soon, not at the next expected data
+                    AddLog("'{0}' transfer incomplete, retrying".format(instance.name))
+                    nextAttempt = time.time() + instance.retryPolicy.baseDelay
+                else:
+                  nextAttempt = OnConnectionFailed(instance, time.time())
+          finally:
+            scheduler.Done(instance)
+            if instance.gateway.profiler is not None:
+              instance.gateway.profiler.OnCycle(instance.name, time.perf_counter() - turnBegin)
+
+          if nextAttempt is not None:
+            scheduler.Plan(instance, nextAttempt)
+            continue
 
           timeout = 0
 
-          if instance.period != 0 and instance.newestSessionTime != 0:
+          nextExpectedDataTime = scheduler.PredictNextSession(instance)
+          if nextExpectedDataTime is not None:
             #try to wait until the next possible data session
             AddDebugLog("new {0} period {1}".format(instance.newestSessionTime, instance.period))
-            nextExpectedDataTime = instance.newestSessionTime + instance.period * 16 * 2
             delay = 60 * 1 #give module some time to write data
             timeout = nextExpectedDataTime - GetUnixtime() + delay
             #timeout = max(timeout, 0) #next data might be past due, happens when module had no data to send
@@ -560,19 +1608,136 @@ async def ReadDevice(instance, name:str):
           
           timeout = max(timeout, 60 * 15)
 
-          nr = datetime.fromtimestamp(GetUnixtime() + timeout).strftime('%Y-%m-%d %H:%M:%S')
+          #an advert showing new data plans the device earlier
+          wakeTime = scheduler.Plan(instance, GetUnixtime() + timeout)
+
+          nr = datetime.fromtimestamp(wakeTime).strftime('%Y-%m-%d %H:%M:%S')
           AddLog("Next read will occur at {0}".format(nr))
-        
-          errors = 0
-          
-          await asyncio.sleep(timeout)    
 
       except Exception as e:
           logger = logging.getLogger(__name__)
           tb = traceback.format_exc()
           logger.warning("exception in ReadDevice for '{2}': {0} {1}".format(e, tb, instance.id))
-          errors += 1
+          scheduler.Plan(instance, OnConnectionFailed(instance, time.time()))
+
+
+class Gateway:
+  def __init__(self, server:str, maxConnections:int, sessionIndexFilepath:str):
+    self.server = server
+    self.maxConnections = maxConnections
+    self.connectionSemaphore = asyncio.Semaphore(maxConnections)
+    self.scanner = ScannerService(self)
+    self.scheduler = ConnectionScheduler(maxConnections)
+    #devices advertising below this RSSI aren't connected, None disables
+    self.minRssi = None
+    #metrics served on (host, port) and written to metricsFilepath, None disables
+    self.metricsAddress = None
+    self.metricsFilepath = None
+    self.metricsInterval = 60
+    #raw BLE traffic, dumped to traceDirectory when a connection fails, None disables
+    self.trace = TraceBuffer()
+    self.traceDirectory = None
+    self.maxTraceFiles = 20
+    #profiling mode reports, None disables
+    self.profiler = None
+    self.uploader = UploadService(server)
+    self.sessionIndex = SessionIndex(sessionIndexFilepath)
+    self.outbox = UploadOutbox(self.sessionIndex.db)
+    self.charHandleCache = {}
+    self.instances = []
+
+  def GetInstance(self, name:str):
+    for instance in self.instances:
+      if instance.name == name:
+        return instance
+    return None
+
+class DeviceInstance:
+  #sync cursor persisted between runs so a restart resumes the
+  #transfer where it stopped instead of dumping the whole module log
+  stateFields = ("newestSessionTime", "oldestSessionTime", "lastBattRead", "period", "address")
+
+  def __init__(self, gateway:Gateway, name:str, readingsFilepath:str, newReadingsFilepath:str, storeFilepath:str, stateFilepath:str):
+    self.gateway = gateway
+    self.id = name
+    self.name = name
+    self.newestSessionTime = 0
+    self.oldestSessionTime = 0
+    self.lastBattRead = 0
+    self.period = 0
+    self.server = gateway.server
+    self.readingsFilepath = readingsFilepath
+    self.newReadingsFilepath = newReadingsFilepath
+    self.store = SessionStore(storeFilepath)
+    self.stateFilepath = stateFilepath
+    self.address = None
+    self.device = None
+    self.manufData = None
+    self.advertEvent = asyncio.Event()
+    self.uploadQueue = asyncio.Queue()
+    self.transferActive = False
+    self.transferComplete = False   #last ReadDataSessions got every session
+    self.enableClear = True
+    self.debug = False
+    self.clearAll = False
+    self.sendTestCommand = False
+    self.testbatt = False
+    #cleared when the module doesn't know "turndata bindisp"
+    self.binaryDisp = True
+    #from version 2 adverts
+    self.flashFill = None
+    self.lastError = None
+    self.tagHash = None
+    #advertised session time that last planned an early read
+    self.promotedSessionTime = 0
+    self.retryPolicy = RetryPolicy()
+    self.rssi = None
+    self.clock = ClockModel(name)
+
+  def OnAdvert(self, device:BLEDevice, manufData:bytes, rssi:int = None):
+    self.address = device.address
+    self.device = device
+    self.manufData = manufData
+    self.rssi = rssi
+    self.clock.OnAdvert(ReadAdvertData(self).sessionTime, time.time())
+    self.advertEvent.set()
+    self.gateway.scheduler.OnAdvert(self)
+
+  def ForgetDevice(self):
+    self.device = None
+    self.manufData = None
+    self.advertEvent.clear()
+
+  def LoadState(self):
+    if os.path.exists(self.stateFilepath) == False:
+      return
 
+    try:
+      with open(self.stateFilepath, "r") as file:
+        state = json.load(file)
+    except ValueError as e:
+      AddLog("WARNING:ignoring invalid state file {0}: {1}".format(self.stateFilepath, e))
+      return
+
+    for field in self.stateFields:
+      if field in state:
+        setattr(self, field, state[field])
+    self.clock.SetState(state.get("clock", {}))
+
+    AddLog("Resuming {0} after session time {1}".format(self.name, self.newestSessionTime))
+
+  def SaveState(self):
+    state = { field : getattr(self, field) for field in self.stateFields }
+    state["clock"] = self.clock.GetState()
+    with AtomicWrite(self.stateFilepath) as file:
+      json.dump(state, file)
+
+def GetArgValue(argv, name:str, default):
+  prefix = name + "="
+  for arg in argv:
+    if arg.startswith(prefix):
+      return arg[len(prefix):]
+  return default
 
 #run this script from a .plist file on macos
 #/Users/michelvachon/Library/LaunchAgents/pepperoni_launcher.plist
@@ -582,55 +1747,102 @@ async def ReadDevice(instance, name:str):
 #unload/stop
 #launchctl unload /Users/michelvachon/Library/LaunchAgents/pepperoni_launcher.plist
 
+#usage:
+#  pepperoni.py [modules=peppeA,peppeB] [maxconn=2]      gateway mode
+#  pepperoni.py peppeA[,peppeB] [maxconn=2] [options]    dev mode
+#
+#  batch=N   upload up to N sessions per request (default 1)
+#  nopacked  send batches as text, for servers without /pepperoni/packed/
+#  flush=S   wait S seconds for a batch to fill before uploading it (default 5)
+#  timeline=S  log the planned connections every S seconds, 0 disables (default 3600)
+#  minrssi=N   don't connect to modules advertising below N dBm (default off)
+#  server=URL  ingest server (default https://devtest.michelvachon.com), see ingestserver.py
+#  cafile=F    trust the certificates in F, for a local https server
+#  metrics=[HOST:]PORT  serve prometheus metrics on /metrics (host defaults to 127.0.0.1)
+#  metricsfile=F        write the metrics as json to F every metricsinterval=S seconds (default 60)
+#  tracedir=D   write the BLE trace of failed connections to D (default traces/), tracedir= disables
+#  tracesize=N  BLE events kept in memory (default 8192)
+#  profile[=D]  profiling mode, writes memory, gc and cpu reports to D (default profile/)
+#  profileinterval=S  at most one report every S seconds, after a connection turn (default 3600)
 async def run():
 
-    mod = "peppe"
+    mods = ["peppe"]
+    devMode = False
 
     argv = sys.argv
 
     script_dir = str(Path( __file__ ).parent.absolute() )
-    
-    instance = type('', (), {})()
-    instance.newestSessionTime = 0
-    instance.oldestSessionTime = 0
-    instance.lastBattRead = 0
-    instance.period = 0
-    instance.server = "https://devtest.michelvachon.com"
-    instance.readingsFilepath = script_dir+"/readings.txt"
-    instance.newReadingsFilepath = script_dir+"/newreadings.txt"
-    instance.device = None
-    instance.enableClear = True
-    instance.debug = False
-    instance.clearAll = False
-    instance.sendTestCommand = False
-    instance.testbatt = False
 
     AddLog(argv)
-    if len(argv) > 1:
+    if len(argv) > 1 and argv[1].find("=") == -1:
 
       global enableDebugLog
       enableDebugLog = True
 
       AddDebugLog("Debug log enabled")
       AddDebugLog("Dev mode")
-      mod = argv[1]
-      
-      instance.readingsFilepath = script_dir+"/readingsB.txt"
-      instance.newReadingsFilepath = script_dir+"/newreadingsB.txt"
-      instance.debug = True
-      instance.enableClear = False
-
-      for arg in argv:
-        if arg == "clearAll":
-          instance.clearAll = True
-
-        if arg == "sendTestCommand":
-          instance.sendTestCommand = True
-
-        if arg == "testbatt":
-          instance.testbatt = True
-
-    if instance.debug:
+      devMode = True
+      mods = argv[1].split(",")
+    else:
+      mods = GetArgValue(argv, "modules", ",".join(mods)).split(",")
+
+    maxConnections = int(GetArgValue(argv, "maxconn", 1))
+
+    indexSuffix = "B" if devMode else ""
+    server = GetArgValue(argv, "server", "https://devtest.michelvachon.com")
+    cafile = GetArgValue(argv, "cafile", None)
+    if cafile is not None:
+      sslContext.load_verify_locations(cafile)
+
+    gateway = Gateway(server, maxConnections, script_dir + "/sessions" + indexSuffix + ".db")
+    gateway.uploader.batchSize = int(GetArgValue(argv, "batch", gateway.uploader.batchSize))
+    gateway.uploader.flushInterval = float(GetArgValue(argv, "flush", gateway.uploader.flushInterval))
+    gateway.uploader.packedSupported = "nopacked" not in argv
+    timelineInterval = float(GetArgValue(argv, "timeline", 3600))
+    minRssi = GetArgValue(argv, "minrssi", None)
+    gateway.minRssi = int(minRssi) if minRssi is not None else None
+    metricsAddress = GetArgValue(argv, "metrics", None)
+    if metricsAddress is not None:
+      host, sep, port = metricsAddress.rpartition(":")
+      gateway.metricsAddress = (host or "127.0.0.1", int(port))
+    gateway.metricsFilepath = GetArgValue(argv, "metricsfile", None)
+    gateway.metricsInterval = float(GetArgValue(argv, "metricsinterval", gateway.metricsInterval))
+    gateway.traceDirectory = GetArgValue(argv, "tracedir", script_dir + "/traces") or None
+    gateway.trace = TraceBuffer(int(GetArgValue(argv, "tracesize", gateway.trace.events.maxlen)))
+    profileDirectory = GetArgValue(argv, "profile", script_dir + "/profile" if "profile" in argv else None)
+    if profileDirectory is not None:
+      gateway.profiler = GatewayProfiler(profileDirectory, float(GetArgValue(argv, "profileinterval", 60 * 60)))
+
+    for mod in mods:
+      suffix = "B" if devMode else ""
+      #keep the historical file names when a single module is served
+      if len(mods) > 1:
+        suffix = "_" + mod + suffix
+
+      instance = DeviceInstance(gateway, mod,
+        script_dir + "/readings" + suffix + ".txt",
+        script_dir + "/newreadings" + suffix + ".txt",
+        script_dir + "/sessions_" + mod + ("B" if devMode else "") + ".bin",
+        script_dir + "/state_" + mod + ("B" if devMode else "") + ".json")
+      instance.LoadState()
+
+      if devMode:
+        instance.debug = True
+        instance.enableClear = False
+
+        for arg in argv:
+          if arg == "clearAll":
+            instance.clearAll = True
+
+          if arg == "sendTestCommand":
+            instance.sendTestCommand = True
+
+          if arg == "testbatt":
+            instance.testbatt = True
+
+      gateway.instances.append(instance)
+
+    if devMode:
 
       AddDebugLog(GetElapsedMillis())
       await asyncio.sleep(0.2)
@@ -638,12 +1850,66 @@ async def run():
       
       #exit() 
     
-    AddLog("Server:" + instance.server)
-    AddLog("Readings:" + instance.readingsFilepath)
-    AddLog("New readings:" + instance.newReadingsFilepath)
-
-    await asyncio.create_task(ReadDevice(instance, mod))
+    AddLog("Server:" + gateway.server)
+    AddLog("Session index:" + script_dir + "/sessions" + indexSuffix + ".db")
+    AddLog("Max connections:{0}".format(gateway.maxConnections))
+    if gateway.minRssi is not None:
+      AddLog("Min RSSI:{0} dBm".format(gateway.minRssi))
+    AddLog("Upload batch:{0} flush:{1}s".format(gateway.uploader.batchSize, gateway.uploader.flushInterval))
+    if gateway.metricsAddress is not None:
+      AddLog("Metrics:http://{0}:{1}/metrics".format(*gateway.metricsAddress))
+    if gateway.metricsFilepath is not None:
+      AddLog("Metrics file:{0} every {1}s".format(gateway.metricsFilepath, gateway.metricsInterval))
+    if gateway.traceDirectory is not None:
+      AddLog("Traces:{0} ({1} events)".format(gateway.traceDirectory, gateway.trace.events.maxlen))
+    if gateway.profiler is not None:
+      AddLog("Profiling:{0} every {1}s".format(gateway.profiler.directory, gateway.profiler.interval))
+    for instance in gateway.instances:
+      AddLog("Module:" + instance.name)
+      AddLog("  Readings:" + instance.readingsFilepath)
+      AddLog("  New readings:" + instance.newReadingsFilepath)
+      AddLog("  Session store:" + instance.store.filepath)
+
+    await RunGateway(gateway, timelineInterval)
+
+async def RunGateway(gateway:Gateway, timelineInterval:float):
+  #serves the gateway's modules until cancelled
+  gateway.uploader.Start()
+  await gateway.scanner.Start()
+  metricsServer = None
+  if gateway.metricsAddress is not None:
+    metricsServer = MetricsServer(metrics, *gateway.metricsAddress).Start()
+  if gateway.profiler is not None:
+    gateway.profiler.Start()
 
+  try:
+    tasks = [asyncio.create_task(gateway.outbox.Run(gateway.uploader))]
+    tasks.append(asyncio.create_task(gateway.scheduler.Run(timelineInterval)))
+    if gateway.metricsFilepath is not None:
+      tasks.append(asyncio.create_task(WriteMetrics(gateway.metricsFilepath, gateway.metricsInterval)))
+    for instance in gateway.instances:
+      ReplayJournal(instance)
+      tasks.append(asyncio.create_task(UploadReadings(instance)))
+      tasks.append(asyncio.create_task(ReadDevice(instance, instance.name)))
+    await asyncio.gather(*tasks)
+  finally:
+    if gateway.profiler is not None:
+      gateway.profiler.Stop()
+    if metricsServer is not None:
+      metricsServer.Stop()
+    if gateway.metricsFilepath is not None:
+      metrics.WriteJson(gateway.metricsFilepath)
+    await gateway.scanner.Stop()
+    await gateway.uploader.Stop()
+    gateway.sessionIndex.Close()
+    for instance in gateway.instances:
+      instance.store.Close()
+
+async def WriteMetrics(filepath:str, interval:float):
+  while True:
+    await asyncio.sleep(interval)
+    metrics.WriteJson(filepath)
 
-loop = asyncio.get_event_loop()
-loop.run_until_complete(run())
+if __name__ == "__main__":
+  loop = asyncio.get_event_loop()
+  loop.run_until_complete(run())
\ No newline at end of file
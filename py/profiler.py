@@ -0,0 +1,154 @@
+import os
+import io
+import gc
+import time
+import asyncio
+import logging
+import pstats
+import cProfile
+import tracemalloc
+from collections import Counter
+from datetime import datetime
+
+#profiling mode of the gateway: after each ReadDevice turn (at most one
+#report every 'interval' seconds) a report is written with the tracemalloc
+#growth since the previous report, the python objects that grew, the gc
+#generation counts and the cProfile stats of the event loop thread.
+#one summary line per report goes to summary.log to follow a slow leak
+#over weeks, the newest 'keepCount' full reports are kept.
+#only the tracemalloc snapshot is taken on the event loop, the comparison,
+#the object count and the formatting run in an executor so a report
+#doesn't stall the notifications of the open connections
+
+class GatewayProfiler:
+  def __init__(self, directory:str, interval:float = 60 * 60, keepCount:int = 50, topCount:int = 25, frameCount:int = 10):
+    self.directory = directory
+    self.interval = interval
+    self.keepCount = keepCount
+    self.topCount = topCount
+    self.frameCount = frameCount
+    self.reportCount = 0
+    self.cycleCount = 0
+    self.lastReport = 0
+    self.snapshot = None
+    self.objectCounts = None
+    self.profile = None
+    self.pendingReport = None
+
+  def Start(self):
+    os.makedirs(self.directory, exist_ok=True)
+    tracemalloc.start(self.frameCount)
+    self.snapshot = self.TakeSnapshot()
+    self.objectCounts = CountObjects()
+    self.lastReport = time.time()
+    self.profile = cProfile.Profile()
+    self.profile.enable()
+
+  def Stop(self):
+    if self.profile is not None:
+      self.profile.disable()
+      self.profile = None
+    tracemalloc.stop()
+
+  def TakeSnapshot(self):
+    return FilterSnapshot(tracemalloc.take_snapshot())
+
+  def OnCycle(self, name:str, duration:float):
+    #called at the end of each ReadDevice turn, from the event loop
+    self.cycleCount += 1
+    if self.pendingReport is not None or time.time() - self.lastReport < self.interval:
+      return
+    self.StartReport(name, duration)
+
+  def StartReport(self, name:str, duration:float):
+    #the profile covers the event loop since the previous report, a new one starts
+    self.profile.disable()
+    profile = self.profile
+    self.profile = cProfile.Profile()
+
+    now = time.time()
+    snapshot = tracemalloc.take_snapshot()
+    traced, peak = tracemalloc.get_traced_memory()
+    self.reportCount += 1
+
+    header = "report {0}, {1}, after the turn of '{2}' ({3:.2f}s), {4} turns in {5:.0f}s\n".format(
+      self.reportCount, datetime.fromtimestamp(now).strftime('%Y-%m-%d %H:%M:%S'), name, duration,
+      self.cycleCount, now - self.lastReport)
+
+    turns = self.cycleCount
+    self.cycleCount = 0
+    self.lastReport = now
+    self.profile.enable()
+
+    self.pendingReport = asyncio.get_running_loop().run_in_executor(None,
+      self.WriteReport, now, header, turns, snapshot, traced, peak, profile)
+    self.pendingReport.add_done_callback(self.OnReportWritten)
+
+  def OnReportWritten(self, future):
+    self.pendingReport = None
+    if future.cancelled() == False and future.exception() is not None:
+      logging.getLogger(__name__).warning("profile report not written: {0}".format(future.exception()))
+
+  def WriteReport(self, now:float, header:str, turns:int, snapshot, traced:int, peak:int, profile):
+    #runs in an executor thread
+    snapshot = FilterSnapshot(snapshot)
+    objectCounts = CountObjects()
+
+    out = io.StringIO()
+    out.write(header)
+    out.write("traced memory {0:.1f} KiB, peak {1:.1f} KiB, process cpu {2:.1f}s\n".format(traced / 1024, peak / 1024, time.process_time()))
+    out.write("gc counts {0}, objects {1}, garbage {2}\n".format(gc.get_count(), sum(objectCounts.values()), len(gc.garbage)))
+    for generation, stats in enumerate(gc.get_stats()):
+      out.write("  gen{0} collections {1} collected {2} uncollectable {3}\n".format(
+        generation, stats["collections"], stats["collected"], stats["uncollectable"]))
+
+    out.write("\nobject growth:\n")
+    growth = objectCounts.copy()
+    growth.subtract(self.objectCounts)
+    for typeName, count in sorted(growth.items(), key=lambda item: -item[1])[:self.topCount]:
+      if count <= 0:
+        break
+      out.write("  {0:+8d} {1:8d} {2}\n".format(count, objectCounts[typeName], typeName))
+
+    out.write("\nallocation growth:\n")
+    for stat in snapshot.compare_to(self.snapshot, "lineno")[:self.topCount]:
+      out.write("  {0}\n".format(stat))
+
+    out.write("\ncpu, by cumulative time:\n")
+    stats = pstats.Stats(profile, stream=out)
+    stats.sort_stats("cumulative").print_stats(self.topCount)
+
+    filepath = os.path.join(self.directory, "profile_{0}.txt".format(datetime.fromtimestamp(now).strftime('%Y%m%d_%H%M%S_%f')))
+    with open(filepath, "w") as report:
+      report.write(out.getvalue())
+
+    with open(os.path.join(self.directory, "summary.log"), "a") as summary:
+      summary.write("{0} report:{1} turns:{2} traced:{3} peak:{4} objects:{5} gc:{6} cpu:{7:.2f}\n".format(
+        datetime.fromtimestamp(now).strftime('%Y-%m-%d %H:%M:%S'), self.reportCount, turns,
+        traced, peak, sum(objectCounts.values()), "/".join(map(str, gc.get_count())), time.process_time()))
+
+    PruneReports(self.directory, self.keepCount)
+
+    self.snapshot = snapshot
+    self.objectCounts = objectCounts
+    return filepath
+
+def FilterSnapshot(snapshot):
+  #the profiler's own allocations are left out
+  return snapshot.filter_traces((
+    tracemalloc.Filter(False, tracemalloc.__file__),
+    tracemalloc.Filter(False, cProfile.__file__),
+    tracemalloc.Filter(False, pstats.__file__),
+    tracemalloc.Filter(False, __file__),
+    tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+    tracemalloc.Filter(False, "<unknown>")))
+
+def CountObjects():
+  #live objects tracked by the gc, by type name
+  return Counter(type(o).__qualname__ for o in gc.get_objects())
+
+def PruneReports(directory:str, keepCount:int):
+  #names sort by time
+  filepaths = sorted(os.path.join(directory, name) for name in os.listdir(directory) if name.startswith("profile_"))
+  for filepath in filepaths[:max(len(filepaths) - keepCount, 0)]:
+    os.remove(filepath)
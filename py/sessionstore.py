@@ -0,0 +1,402 @@
+import os
+import sys
+import mmap
+import base64
+import struct
+import binascii
+import contextlib
+from array import array
+from itertools import compress, cycle
+
+try:
+  import numpy
+except ImportError:
+  numpy = None
+
+#one record per data session, same layout as the firmware's DataSession:
+#m_time, m_id, m_period then the 16 uint16 m_values
+maxValues = 16
+recordStruct = struct.Struct("<III{0}H".format(maxValues))
+recordSize = recordStruct.size
+
+#magic, version, record size, count of records sorted by time
+headerStruct = struct.Struct("<4sHHI")
+headerSize = headerStruct.size
+storeMagic = b"PPSS"
+storeVersion = 1
+
+if numpy is not None:
+  recordDtype = numpy.dtype([
+    ("time", "<u4"),
+    ("id", "<u4"),
+    ("period", "<u4"),
+    ("values", "<u2", (maxValues,))])
+
+class SessionRecord:
+  #one data session, as printed by the firmware:
+  #"id:<id> t:<time> p:<period> v0 ... v15"
+  __slots__ = ("id", "time", "period", "values")
+
+  def __init__(self, id:int, time:int, period:int, values):
+    self.id = id
+    self.time = time
+    self.period = period
+    self.values = values
+
+  def ToLine(self):
+    return "id:{0} t:{1} p:{2} {3}".format(self.id, self.time, self.period, " ".join(map(str, self.values)))
+
+def ParseSession(line:str):
+  #single pass parse of a session line, raises ValueError when invalid
+  words = line.split()
+  if len(words) < 3 or len(words) > 3 + maxValues or words[0][:3] != "id:" or words[1][:2] != "t:" or words[2][:2] != "p:":
+    raise ValueError("invalid session '{0}'".format(line.strip()))
+
+  return SessionRecord(int(words[0][3:]), int(words[1][2:]), int(words[2][2:]), list(map(int, words[3:])))
+
+#what is left of "id:", "t:" and "p:" when a notification cut the start of a word
+fragmentPrefixes = ("id:", "d:", "t:", "p:", ":")
+base64Chars = frozenset("ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789+/=")
+
+def IsSessionFragment(line:str, binary:bool = False):
+  #true for the tail of a session line, or of a frame when 'binary', whose start
+  #was lost with a notification. the first word may be the start of another
+  #line the lost notification merged with. other firmware output, logs or
+  #"Batt:", is not
+  words = line.split()
+  if len(words) == 0:
+    return False
+
+  if binary and len(words) <= 2 and base64Chars.issuperset(words[-1]):
+    return True
+
+  for word in words[1:] if len(words) > 1 else words:
+    for prefix in fragmentPrefixes:
+      if word.startswith(prefix):
+        word = word[len(prefix):]
+        break
+    if word and word.isdigit() == False:
+      return False
+  return True
+
+fieldCount = 3 + maxValues
+
+def ParseSessions(text:str):
+  #bulk parse of a "turndata disp" dump or readings file into columns.
+  #session lines are joined and converted with one split, lines that
+  #don't have exactly 16 values fall back to ParseSession
+  lines = [line for line in text.splitlines() if line.startswith("id:")]
+  fields = " ".join(lines).replace("id:", "").replace("t:", "").replace("p:", "").split()
+
+  if len(fields) != len(lines) * fieldCount:
+    records = []
+    for line in lines:
+      try:
+        records.append(ParseSession(line))
+      except ValueError:
+        pass
+    return MakeColumns(records)
+
+  if numpy is not None:
+    data = numpy.array(fields, dtype=numpy.uint32).reshape(-1, fieldCount)
+    return SessionColumns(data[:, 1].copy(), data[:, 0].copy(), data[:, 2].copy(), data[:, 3:].astype(numpy.uint16))
+
+  valueMask = cycle((False,) * 3 + (True,) * maxValues)
+  return SessionColumns(
+    array("I", map(int, fields[1::fieldCount])),
+    array("I", map(int, fields[0::fieldCount])),
+    array("I", map(int, fields[2::fieldCount])),
+    array("H", map(int, compress(fields, valueMask))))
+
+#"turndata bindisp" frame: version, id, time and period as varints, then the
+#values as varint tokens (see WriteValueTokens) and the CRC-16/CCITT-FALSE of
+#the preceding bytes. base64 encoded without padding after "s:"
+frameCrcStruct = struct.Struct("<H")
+frameVersion = 2
+framePrefix = "s:"
+
+def WriteVarint(out:bytearray, value:int):
+  while value >= 0x80:
+    out.append((value & 0x7f) | 0x80)
+    value >>= 7
+  out.append(value)
+
+def ReadVarint(data:bytes, offset:int):
+  #returns the value and the offset after it
+  value = 0
+  shift = 0
+  while True:
+    if offset >= len(data):
+      raise ValueError("truncated varint")
+    byte = data[offset]
+    offset += 1
+    value |= (byte & 0x7f) << shift
+    if byte < 0x80:
+      return value, offset
+    shift += 7
+
+def WriteValueTokens(out:bytearray, values):
+  #a run of zeros is (length << 1) | 1, a value is value << 1
+  i = 0
+  while i < len(values):
+    if values[i] == 0:
+      run = 1
+      while i + run < len(values) and values[i + run] == 0:
+        run += 1
+      WriteVarint(out, (run << 1) | 1)
+      i += run
+    else:
+      WriteVarint(out, values[i] << 1)
+      i += 1
+
+def ReadValueTokens(data:bytes, offset:int, count:int):
+  #returns 'count' values and the offset after their tokens
+  values = []
+  while len(values) < count:
+    token, offset = ReadVarint(data, offset)
+    if token & 1 == 0:
+      values.append(token >> 1)
+    elif token >> 1 <= count - len(values):
+      values.extend([0] * (token >> 1))
+    else:
+      raise ValueError("zero run past the session values")
+  return values, offset
+
+def EncodeSessionFrame(record:SessionRecord):
+  #the firmware's DisplayDataSessionFrame, for the simulator and the benchmarks
+  frame = bytearray([frameVersion])
+  WriteVarint(frame, record.id)
+  WriteVarint(frame, record.time)
+  WriteVarint(frame, record.period)
+  WriteValueTokens(frame, record.values)
+  frame += frameCrcStruct.pack(binascii.crc_hqx(frame, 0xffff))
+  return framePrefix + base64.b64encode(frame).decode().rstrip("=")
+
+def DecodeSessionFrame(line:str):
+  #raises ValueError when invalid
+  text = line[len(framePrefix):].strip()
+  try:
+    frame = base64.b64decode(text + "=" * (-len(text) % 4), validate=True)
+  except binascii.Error:
+    raise ValueError("invalid frame '{0}'".format(line.strip()))
+
+  if len(frame) < 1 + frameCrcStruct.size or frame[0] != frameVersion:
+    raise ValueError("unsupported frame version {0}".format(frame[0] if frame else None))
+
+  if binascii.crc_hqx(frame[:-frameCrcStruct.size], 0xffff) != frameCrcStruct.unpack_from(frame, len(frame) - frameCrcStruct.size)[0]:
+    raise ValueError("frame crc mismatch")
+
+  data = frame[:-frameCrcStruct.size]
+  sessionId, offset = ReadVarint(data, 1)
+  sessionTime, offset = ReadVarint(data, offset)
+  period, offset = ReadVarint(data, offset)
+  values, offset = ReadValueTokens(data, offset, maxValues)
+  if offset != len(data):
+    raise ValueError("{0} trailing frame bytes".format(len(data) - offset))
+
+  return SessionRecord(sessionId, sessionTime, period, values)
+
+def MakeColumns(records):
+  values = array("H")
+  for record in records:
+    values.extend(record.values[:maxValues])
+    values.extend([0] * (maxValues - len(record.values)))
+  return SessionColumns(
+    array("I", [record.time for record in records]),
+    array("I", [record.id for record in records]),
+    array("I", [record.period for record in records]),
+    values)
+
+class SessionColumns:
+  #query result, one array per field.
+  #numpy arrays when numpy is installed ('values' is then count x 16),
+  #array.array otherwise ('values' is flat, 16 entries per session)
+  def __init__(self, time, id, period, values):
+    self.time = time
+    self.id = id
+    self.period = period
+    self.values = values
+
+  def __len__(self):
+    return len(self.time)
+
+  def GetValues(self, index:int):
+    if numpy is not None:
+      return self.values[index]
+    return self.values[index * maxValues:(index + 1) * maxValues]
+
+class SessionStore:
+  #fixed width binary records of one device.
+  #records appended in time order extend the sorted prefix that range
+  #queries bisect, the rest is scanned until the next compaction
+  compactThreshold = 256
+
+  def __init__(self, filepath:str):
+    self.filepath = filepath
+
+    if os.path.exists(filepath) == False:
+      self.WriteRecords(filepath, [])
+
+    self.Open()
+
+  def Open(self):
+    self.file = open(self.filepath, "r+b")
+
+    magic, version, size, self.sortedCount = headerStruct.unpack(self.file.read(headerSize))
+    if magic != storeMagic or version != storeVersion or size != recordSize:
+      raise ValueError("{0} is not a session store".format(self.filepath))
+
+    self.file.seek(0, os.SEEK_END)
+    self.count = (self.file.tell() - headerSize) // recordSize
+    if self.file.tell() != headerSize + self.count * recordSize:
+      #a record torn by a crash, later appends must stay aligned
+      self.file.truncate(headerSize + self.count * recordSize)
+    self.sortedCount = min(self.sortedCount, self.count)
+    self.lastTime = 0
+    if self.count:
+      self.lastTime = self.ReadRecord(self.count - 1)[0]
+
+  def Close(self):
+    self.Flush()
+    self.file.close()
+
+  def ReadRecord(self, index:int):
+    self.file.seek(headerSize + index * recordSize)
+    return recordStruct.unpack(self.file.read(recordSize))
+
+  def Append(self, record:SessionRecord):
+    values = list(record.values[:maxValues])
+    values += [0] * (maxValues - len(values))
+
+    self.file.seek(0, os.SEEK_END)
+    self.file.write(recordStruct.pack(record.time, record.id, record.period, *values))
+
+    if self.sortedCount == self.count and record.time >= self.lastTime:
+      self.sortedCount += 1
+    self.count += 1
+    self.lastTime = record.time
+
+  def Flush(self):
+    self.file.seek(0)
+    self.file.write(headerStruct.pack(storeMagic, storeVersion, recordSize, self.sortedCount))
+    self.file.flush()
+
+  def NeedsCompaction(self):
+    return self.count - self.sortedCount >= self.compactThreshold
+
+  def Query(self, beginTime:int = 0, endTime:int = 1 << 32):
+    #sessions with beginTime <= time < endTime
+    self.file.flush()
+    if self.count == 0:
+      return MakeColumns([])
+
+    with mmap.mmap(self.file.fileno(), headerSize + self.count * recordSize, access=mmap.ACCESS_READ) as view:
+      if numpy is not None:
+        return self.QueryNumpy(view, beginTime, endTime)
+
+      first = self.FindFirst(view, beginTime)
+      last = self.FindFirst(view, endTime)
+      records = [recordStruct.unpack_from(view, headerSize + i * recordSize) for i in range(first, last)]
+
+      #records appended out of order since the last compaction
+      for i in range(self.sortedCount, self.count):
+        record = recordStruct.unpack_from(view, headerSize + i * recordSize)
+        if record[0] >= beginTime and record[0] < endTime:
+          records.append(record)
+
+      return MakeColumns([SessionRecord(r[1], r[0], r[2], r[3:]) for r in records])
+
+  def QueryNumpy(self, view, beginTime:int, endTime:int):
+    records = numpy.frombuffer(view, recordDtype, self.count, headerSize)
+    times = records["time"]
+
+    sortedTimes = times[:self.sortedCount]
+    first = numpy.searchsorted(sortedTimes, beginTime, "left")
+    last = numpy.searchsorted(sortedTimes, endTime, "left")
+
+    tail = records[self.sortedCount:]
+    tail = tail[(tail["time"] >= beginTime) & (tail["time"] < endTime)]
+
+    #copies, the mapping is closed on return
+    result = numpy.concatenate((records[first:last], tail))
+    return SessionColumns(result["time"].copy(), result["id"].copy(), result["period"].copy(), result["values"].copy())
+
+  def FindFirst(self, view, sessionTime:int):
+    #index of the first sorted record with time >= sessionTime
+    low = 0
+    high = self.sortedCount
+    while low < high:
+      middle = (low + high) // 2
+      if struct.unpack_from("<I", view, headerSize + middle * recordSize)[0] < sessionTime:
+        low = middle + 1
+      else:
+        high = middle
+    return low
+
+  def Compact(self):
+    #sorts by time and drops duplicated (id, time) records
+    self.file.flush()
+    self.file.seek(headerSize)
+    data = self.file.read(self.count * recordSize)
+
+    records = {}
+    for record in recordStruct.iter_unpack(data):
+      records[(record[1], record[0])] = record
+    records = sorted(records.values(), key=lambda record: record[0])
+
+    self.file.close()
+    self.WriteRecords(self.filepath, records)
+    self.Open()
+
+  @staticmethod
+  def WriteRecords(filepath:str, records):
+    with AtomicWrite(filepath, "wb") as file:
+      file.write(headerStruct.pack(storeMagic, storeVersion, recordSize, len(records)))
+      for record in records:
+        file.write(recordStruct.pack(*record))
+
+@contextlib.contextmanager
+def AtomicWrite(filepath:str, mode:str = "w"):
+  #written aside, fsynced then renamed, a crash leaves either the old or the new file
+  tempFilepath = filepath + ".tmp"
+  with open(tempFilepath, mode) as file:
+    yield file
+    file.flush()
+    os.fsync(file.fileno())
+  os.replace(tempFilepath, filepath)
+
+def ImportReadings(store:SessionStore, readingsFilepath:str):
+  #readings.txt lines: "id:<id> t:<time> p:<period> v0 ... v15"
+  count = 0
+  with open(readingsFilepath, "r") as readings:
+    for line in readings:
+      try:
+        store.Append(ParseSession(line))
+        count += 1
+      except ValueError:
+        pass
+  store.Compact()
+  return count
+
+#usage:
+#  sessionstore.py import <readings.txt> <store.bin>
+#  sessionstore.py query <store.bin> [beginTime] [endTime]
+if __name__ == "__main__":
+  argv = sys.argv
+
+  if len(argv) >= 4 and argv[1] == "import":
+    store = SessionStore(argv[3])
+    print("imported", ImportReadings(store, argv[2]), "sessions")
+    store.Close()
+
+  elif len(argv) >= 3 and argv[1] == "query":
+    store = SessionStore(argv[2])
+    beginTime = int(argv[3]) if len(argv) > 3 else 0
+    endTime = int(argv[4]) if len(argv) > 4 else 1 << 32
+    columns = store.Query(beginTime, endTime)
+    for i in range(len(columns)):
+      print("id:{0} t:{1} p:{2} {3}".format(columns.id[i], columns.time[i], columns.period[i], " ".join(str(v) for v in columns.GetValues(i))))
+    store.Close()
+
+  else:
+    print("usage: sessionstore.py import <readings.txt> <store.bin> | query <store.bin> [beginTime] [endTime]")
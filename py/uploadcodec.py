@@ -0,0 +1,136 @@
+import sys
+import gzip
+import urllib.parse
+from sessionstore import SessionRecord, ParseSession, WriteVarint, ReadVarint, WriteValueTokens, ReadValueTokens
+
+#packed upload of many sessions of one module, POSTed gzipped to
+#/pepperoni/packed/ with contentType. version 1 layout, before gzip:
+#  version                      byte
+#  module name                  varint length, utf-8
+#  session count                varint
+#  then per session, each field relative to the previous session:
+#    time                       zigzag varint, minus previous time + previous period * 16
+#    id                         zigzag varint, minus previous id
+#    period                     zigzag varint, minus previous period
+#    value count                varint
+#    values                     tokens, a zero run is (length << 1) | 1, a value is value << 1
+#the first session is relative to zeros. DecodeSessions is the reference decoder
+
+packedVersion = 1
+contentType = "application/vnd.pepperoni.sessions; version={0}".format(packedVersion)
+sessionValueCount = 16
+
+def ZigZag(value:int):
+  return value * 2 if value >= 0 else -value * 2 - 1
+
+def UnZigZag(value:int):
+  return value >> 1 if value & 1 == 0 else -(value >> 1) - 1
+
+def EncodeSessions(deviceName:str, sessions):
+  out = bytearray([packedVersion])
+  name = deviceName.encode()
+  WriteVarint(out, len(name))
+  out += name
+  WriteVarint(out, len(sessions))
+
+  previousTime = 0
+  previousId = 0
+  previousPeriod = 0
+  for record in sessions:
+    WriteVarint(out, ZigZag(record.time - (previousTime + previousPeriod * sessionValueCount)))
+    WriteVarint(out, ZigZag(record.id - previousId))
+    WriteVarint(out, ZigZag(record.period - previousPeriod))
+    previousTime, previousId, previousPeriod = record.time, record.id, record.period
+
+    WriteVarint(out, len(record.values))
+    WriteValueTokens(out, record.values)
+
+  return gzip.compress(bytes(out), 9, mtime=0)
+
+def DecodeSessions(payload:bytes):
+  #returns the module name and its sessions, raises ValueError when invalid
+  try:
+    data = gzip.decompress(payload)
+  except (OSError, EOFError) as e:
+    raise ValueError("invalid gzip payload: {0}".format(e))
+
+  if len(data) == 0 or data[0] != packedVersion:
+    raise ValueError("unsupported packed version {0}".format(data[0] if data else None))
+
+  length, offset = ReadVarint(data, 1)
+  deviceName = data[offset:offset + length].decode()
+  offset += length
+  count, offset = ReadVarint(data, offset)
+
+  sessions = []
+  previousTime = 0
+  previousId = 0
+  previousPeriod = 0
+  for i in range(count):
+    delta, offset = ReadVarint(data, offset)
+    sessionTime = previousTime + previousPeriod * sessionValueCount + UnZigZag(delta)
+    delta, offset = ReadVarint(data, offset)
+    sessionId = previousId + UnZigZag(delta)
+    delta, offset = ReadVarint(data, offset)
+    period = previousPeriod + UnZigZag(delta)
+    previousTime, previousId, previousPeriod = sessionTime, sessionId, period
+
+    valueCount, offset = ReadVarint(data, offset)
+    values, offset = ReadValueTokens(data, offset, valueCount)
+
+    sessions.append(SessionRecord(sessionId, sessionTime, period, values))
+
+  if offset != len(data):
+    raise ValueError("{0} trailing bytes".format(len(data) - offset))
+
+  return deviceName, sessions
+
+def GetFormSize(deviceName:str, sessions):
+  #bytes of the same sessions as /pepperoni/ requests, one per session
+  return sum(len(urllib.parse.urlencode({
+    'mod' : deviceName,
+    'cnt' : record.id,
+    'prd' : record.period,
+    'time' : record.time,
+    'readings' : ",".join(map(str, record.values)) })) for record in sessions)
+
+def GetBatchSize(deviceName:str, sessions):
+  #bytes of the same sessions as one /pepperoni/batch/ request
+  return len(urllib.parse.urlencode({
+    'mod' : deviceName,
+    'sessions' : "\n".join(record.ToLine() for record in sessions) }))
+
+#usage: uploadcodec.py <readings.txt> [batch=64]
+#compares the request body bytes of each upload encoding, headers excluded
+if __name__ == "__main__":
+  argv = sys.argv
+  if len(argv) < 2:
+    print("usage: uploadcodec.py <readings.txt> [batch=64]")
+    sys.exit(1)
+
+  batchSize = 64
+  for arg in argv[2:]:
+    if arg.startswith("batch="):
+      batchSize = int(arg[len("batch="):])
+
+  records = []
+  with open(argv[1], "r") as readings:
+    for line in readings:
+      try:
+        records.append(ParseSession(line))
+      except ValueError:
+        pass
+
+  chunks = [records[begin:begin + batchSize] for begin in range(0, len(records), batchSize)]
+  formSize = GetFormSize("peppeA", records)
+  batchBytes = sum(GetBatchSize("peppeA", chunk) for chunk in chunks)
+  packedSize = 0
+  for chunk in chunks:
+    payload = EncodeSessions("peppeA", chunk)
+    if [r.ToLine() for r in DecodeSessions(payload)[1]] != [r.ToLine() for r in chunk]:
+      raise ValueError("round trip mismatch")
+    packedSize += len(payload)
+
+  print("{0} sessions, {1} requests of up to {2}".format(len(records), len(chunks), len(chunks[0]) if chunks else 0))
+  for name, size in (("form, one per session", formSize), ("batch", batchBytes), ("packed", packedSize)):
+    print("{0:<22} {1:>10} bytes {2:>8.1f} per session {3:>6.1f}x".format(name, size, size / max(len(records), 1), formSize / max(size, 1)))
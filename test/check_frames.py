@@ -0,0 +1,21 @@
+import os
+import sys
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "py"))
+from sessionstore import ParseSession, DecodeSessionFrame, framePrefix
+
+#the binary frames of the firmware decode to the same sessions as its text lines
+#usage: ./datacollector_test dump | python3 check_frames.py
+if __name__ == "__main__":
+  text = []
+  binary = []
+  for line in sys.stdin.read().splitlines():
+    line = line.strip("\r")
+    if line.startswith("id:"):
+      text.append(ParseSession(line).ToLine())
+    elif line.startswith(framePrefix):
+      binary.append(DecodeSessionFrame(line).ToLine())
+
+  if len(text) == 0 or text != binary:
+    print("frames FAILED, {0} text sessions, {1} frames".format(len(text), len(binary)))
+    sys.exit(1)
+  print("frames passed, {0} sessions".format(len(text)))
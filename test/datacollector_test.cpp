@@ -0,0 +1,320 @@
+//host build of datacollector.cpp against the stand-ins in test/gj, run with: make -C test
+
+#include "../datacollector.h"
+#include "gj/eventmanager.h"
+#include "gj/appendonlyfile.h"
+#include "gj/datetime.h"
+#include <map>
+#include <deque>
+#include <vector>
+#include <sstream>
+
+std::string g_serOutput;
+int32_t g_terminalRoom = 1000000;
+
+bool AreTerminalsReady()
+{
+  return g_terminalRoom > 0;
+}
+
+uint32_t GetUnixtime()
+{
+  return 1600000000;
+}
+
+std::deque<EventManager::Function> s_events;
+EventManager s_eventManager;
+EventManager *GJEventManager = &s_eventManager;
+
+void EventManager::Add(Function f)
+{
+  s_events.push_back(f);
+}
+
+void EventManager::DelayAdd(Function f, uint64_t delay)
+{
+  s_events.push_back(f);
+}
+
+std::map<std::string, std::vector<uint8_t>> s_files;
+std::vector<uint8_t> s_pendingBlock;
+uint32_t AppendOnlyFile::s_capacity = 64 * 1024;
+
+AppendOnlyFile::AppendOnlyFile(const char *path)
+: m_path(path)
+{
+}
+
+bool AppendOnlyFile::BeginWrite(uint32_t size)
+{
+  if (s_files[m_path].size() + 4 + ((size + 3) & ~3) > s_capacity)
+    return false;
+  s_pendingBlock.clear();
+  return true;
+}
+
+bool AppendOnlyFile::Write(const void *data, uint32_t size)
+{
+  s_pendingBlock.insert(s_pendingBlock.end(), (const uint8_t*)data, (const uint8_t*)data + size);
+  return true;
+}
+
+bool AppendOnlyFile::EndWrite()
+{
+  std::vector<uint8_t> &file = s_files[m_path];
+  const uint32_t size = s_pendingBlock.size();
+  file.insert(file.end(), (const uint8_t*)&size, (const uint8_t*)&size + 4);
+  file.insert(file.end(), s_pendingBlock.begin(), s_pendingBlock.end());
+  file.resize((file.size() + 3) & ~3);
+  return true;
+}
+
+void AppendOnlyFile::Erase()
+{
+  s_files[m_path].clear();
+}
+
+void AppendOnlyFile::ForEach(std::function<void(uint32_t size, const void *data)> callback)
+{
+  const std::vector<uint8_t> &file = s_files[m_path];
+
+  uint32_t offset = 0;
+  while (offset + 4 <= file.size())
+  {
+    uint32_t size;
+    memcpy(&size, file.data() + offset, 4);
+    callback(size, file.data() + offset + 4);
+    offset += 4 + ((size + 3) & ~3);
+  }
+}
+
+static int s_failures = 0;
+
+#define CHECK(c) \
+  do { \
+    if (!(c)) \
+    { \
+      printf("%s:%d: CHECK(%s) failed\n", __FILE__, __LINE__, #c); \
+      s_failures++; \
+    } \
+  } while(0)
+
+//runs the queued events, the terminals take 'room' lines per event like a refill
+uint32_t RunEvents(int32_t room)
+{
+  uint32_t count = 0;
+  while (!s_events.empty())
+  {
+    EventManager::Function f = s_events.front();
+    s_events.pop_front();
+    g_terminalRoom = room;
+    f();
+    count++;
+  }
+  g_terminalRoom = 1000000;
+  return count;
+}
+
+struct Dump
+{
+  std::vector<uint32_t> m_times;
+  uint32_t m_frames = 0;
+  int32_t m_total = -1;
+};
+
+Dump ParseDump(const std::string &output)
+{
+  Dump dump;
+  std::istringstream lines(output);
+  std::string line;
+  while (std::getline(lines, line))
+  {
+    //the firmware ends some lines with \n\r, the \r lands at the start of the next one
+    line.erase(0, line.find_first_not_of('\r'));
+    uint32_t id, time, period;
+    if (sscanf(line.c_str(), "id:%u t:%u p:%u", &id, &time, &period) == 3)
+      dump.m_times.push_back(time);
+    if (line.compare(0, 2, "s:") == 0)
+      dump.m_frames++;
+    sscanf(line.c_str(), "Total readings:%d", &dump.m_total);
+  }
+  return dump;
+}
+
+Dump RunDisplay(const DataCollector &collector, uint32_t minTime, uint32_t startIndex, int32_t room, bool binary = false)
+{
+  g_serOutput.clear();
+  g_terminalRoom = room;
+  Display(collector, minTime, startIndex, binary);
+  RunEvents(room);
+  return ParseDump(g_serOutput);
+}
+
+std::vector<uint32_t> MakeTimes(uint32_t first, uint32_t count)
+{
+  std::vector<uint32_t> times;
+  for (uint32_t i = 0 ; i < count ; ++i)
+    times.push_back(first + i * 1600);
+  return times;
+}
+
+DataCollector* MakeCollector(const char *path, uint32_t count)
+{
+  s_files[path].clear();
+  DataCollector *collector = InitDataCollector(path, 7, 100);
+  for (uint32_t time : MakeTimes(1000, count))
+  {
+    InitDataSession(*collector, time);
+    AddData(*collector, time, time % 5);
+    WriteDataSession(*collector);
+  }
+  return collector;
+}
+
+DataCollector* MakeReadingsCollector(const char *path, uint32_t count)
+{
+  //a few readings per session, some of them large
+  s_files[path].clear();
+  DataCollector *collector = InitDataCollector(path, 0x12345, 900);
+  for (uint32_t time : MakeTimes(1600000000, count))
+  {
+    InitDataSession(*collector, time);
+    for (uint32_t i = 0 ; i < 16 ; ++i)
+    {
+      const uint32_t hash = (time / 1600 + i) * 2654435761u;
+      if (hash % 3 == 0)
+        AddData(*collector, time + i * 900, (hash >> 8) % 400 + 1);
+    }
+    if (time % 7 == 0)
+      AddData(*collector, time, 65535);
+    WriteDataSession(*collector);
+  }
+  return collector;
+}
+
+void TestRefills()
+{
+  //every session shown once whatever the terminal room at each refill
+  DataCollector *collector = MakeCollector("/refill", 50);
+  for (int32_t room : {1, 2, 3, 7, 1000})
+  {
+    Dump dump = RunDisplay(*collector, 0, 0, room);
+    CHECK(dump.m_times == MakeTimes(1000, 50));
+    CHECK(dump.m_total == 50);
+  }
+  CHECK(GetStoredSessionCount(*collector) == 50);
+  //the flash fill counts the blocks' size headers
+  CHECK(GetStoredBytes(*collector) == s_files["/refill"].size());
+  CHECK(GetStoredBytes(*InitDataCollector("/refill", 7, 100)) == s_files["/refill"].size());
+}
+
+void TestMinTime()
+{
+  DataCollector *collector = MakeCollector("/mintime", 20);
+
+  Dump dump = RunDisplay(*collector, 1000 + 12 * 1600, 0, 2);
+  CHECK(dump.m_times == MakeTimes(1000 + 12 * 1600, 8));
+  CHECK(dump.m_total == 8);
+
+  dump = RunDisplay(*collector, 1000 + 12 * 1600 + 1, 0, 2);
+  CHECK(dump.m_times == MakeTimes(1000 + 13 * 1600, 7));
+
+  dump = RunDisplay(*collector, 0xffffffff, 0, 2);
+  CHECK(dump.m_times.empty());
+  CHECK(dump.m_total == 0);
+}
+
+void TestStartIndex()
+{
+  DataCollector *collector = MakeCollector("/start", 20);
+
+  Dump dump = RunDisplay(*collector, 0, 5, 3);
+  CHECK(dump.m_times == MakeTimes(1000 + 5 * 1600, 15));
+  CHECK(dump.m_total == 15);
+
+  //the index counts sessions >= minTime
+  dump = RunDisplay(*collector, 1000 + 10 * 1600, 4, 3);
+  CHECK(dump.m_times == MakeTimes(1000 + 14 * 1600, 6));
+
+  dump = RunDisplay(*collector, 0, 19, 3);
+  CHECK(dump.m_times == MakeTimes(1000 + 19 * 1600, 1));
+
+  for (uint32_t index : {20u, 21u, 1000u})
+  {
+    dump = RunDisplay(*collector, 0, index, 3);
+    CHECK(dump.m_times.empty());
+    CHECK(dump.m_total == 0);
+  }
+}
+
+void TestSeveralSessionsPerBlock()
+{
+  //blocks of 3 sessions, the cursor resumes inside a block
+  const char *path = "/blocks";
+  s_files[path].clear();
+  DataCollector *collector = InitDataCollector(path, 7, 100);
+
+  std::vector<uint32_t> times = MakeTimes(1000, 12);
+  AppendOnlyFile file(path);
+  for (uint32_t i = 0 ; i < times.size() ; i += 3)
+  {
+    file.BeginWrite(3 * 44);
+    for (uint32_t j = i ; j < i + 3 ; ++j)
+    {
+      uint32_t session[11] = {times[j], 7, 100};
+      file.Write(session, sizeof(session));
+    }
+    file.EndWrite();
+  }
+
+  for (int32_t room : {1, 2, 4})
+  {
+    Dump dump = RunDisplay(*collector, 0, 0, room);
+    CHECK(dump.m_times == times);
+    CHECK(dump.m_total == 12);
+  }
+
+  Dump dump = RunDisplay(*collector, 0, 4, 2);
+  CHECK(dump.m_times == std::vector<uint32_t>(times.begin() + 4, times.end()));
+}
+
+void TestBinaryFrames()
+{
+  DataCollector *collector = MakeReadingsCollector("/frames", 30);
+
+  for (int32_t room : {1, 2, 1000})
+  {
+    Dump binary = RunDisplay(*collector, 0, 0, room, true);
+    CHECK(binary.m_frames == 30);
+    CHECK(binary.m_total == 30);
+    CHECK(g_serOutput.find('=') == std::string::npos);
+  }
+
+  //smaller than the text lines of the same sessions
+  const std::string binaryOutput = g_serOutput;
+  RunDisplay(*collector, 0, 0, 1000);
+  CHECK(binaryOutput.size() * 10 < g_serOutput.size() * 7);
+}
+
+int main(int argc, char **argv)
+{
+  if (argc > 1 && strcmp(argv[1], "dump") == 0)
+  {
+    //text then binary dump of the same sessions, for check_frames.py
+    DataCollector *collector = MakeReadingsCollector("/dump", 200);
+    RunDisplay(*collector, 0, 0, 3);
+    printf("%s", g_serOutput.c_str());
+    RunDisplay(*collector, 0, 0, 3, true);
+    printf("%s", g_serOutput.c_str());
+    return 0;
+  }
+
+  TestRefills();
+  TestMinTime();
+  TestStartIndex();
+  TestSeveralSessionsPerBlock();
+  TestBinaryFrames();
+
+  printf("%s\n", s_failures ? "FAILED" : "passed");
+  return s_failures ? 1 : 0;
+}
@@ -0,0 +1,24 @@
+#pragma once
+
+#include <cstdint>
+#include <functional>
+
+//host stand-in for the GrosJambon append-only file: blocks of a 4 byte
+//size then the data padded to 4 bytes, kept in memory per path
+class AppendOnlyFile
+{
+public:
+  AppendOnlyFile(const char *path);
+
+  bool BeginWrite(uint32_t size);
+  bool Write(const void *data, uint32_t size);
+  bool EndWrite();
+  void Erase();
+
+  void ForEach(std::function<void(uint32_t size, const void *data)> callback);
+
+  static uint32_t s_capacity;
+
+private:
+  const char *m_path;
+};
@@ -0,0 +1,31 @@
+#pragma once
+
+//host stand-in for the GrosJambon base header, just what datacollector.cpp uses
+
+#include <cstdint>
+#include <cstdio>
+#include <cstdlib>
+#include <cstring>
+#include <string>
+#include <functional>
+
+//everything SER prints, the test reads it back
+extern std::string g_serOutput;
+//lines the terminals still accept before AreTerminalsReady() turns false
+extern int32_t g_terminalRoom;
+
+bool AreTerminalsReady();
+
+#define SER(...) \
+  do { \
+    char serBuffer[512]; \
+    snprintf(serBuffer, sizeof(serBuffer), __VA_ARGS__); \
+    g_serOutput += serBuffer; \
+    g_terminalRoom--; \
+  } while(0)
+
+#define APP_ERROR_CHECK_BOOL(b) \
+  do { \
+    if (!(b)) \
+      abort(); \
+  } while(0)
@@ -0,0 +1,14 @@
+#pragma once
+
+#include <cstdint>
+#include <functional>
+
+struct EventManager
+{
+  typedef std::function<void()> Function;
+
+  void Add(Function f);
+  void DelayAdd(Function f, uint64_t delay);
+};
+
+extern EventManager *GJEventManager;